@@ -0,0 +1,145 @@
+"""
+Concurrent call throughput of the sync development server (`app.run`),
+the single process gevent server in serve.py, and gunicorn as configured
+by gunicorn.conf.py.
+
+Directions lookups are faked with a fixed sleep standing in for the
+round trip to Google, so this measures how well each server overlaps
+waiting callers, not Google.
+
+    python3 -m benchmarks.concurrent_calls [--calls 200] [--concurrency 50]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import subprocess
+from urllib.request import Request, urlopen
+from urllib.error import URLError
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_LATENCY = 0.2
+DUMMY_AUTH = {
+    'GOOGLE_MAPS_DIRECTIONS': 'AIza' + 'x' * 35,
+    'TWILIO_ACCOUNT_SID': 'x',
+    'TWILIO_AUTH_TOKEN': 'x',
+    'SPEECH_USERNAME': 'x',
+    'SPEECH_PASSWORD': 'x',
+}
+
+
+def fake_directions(*args, **kwargs):
+    time.sleep(BACKEND_LATENCY)
+    return [{'legs': [{'steps': [
+        {'html_instructions': 'Walk <b>home</b>', 'travel_mode': 'WALKING'}
+    ]}]}]
+
+
+def run_gunicorn(port):
+    from gunicorn.app.base import Application
+
+    class Gunicorn(Application):
+        def init(self, parser, opts, args):
+            pass
+
+        def load_config(self):
+            self.load_config_from_file('gunicorn.conf.py')
+            self.cfg.set('bind', '127.0.0.1:{}'.format(port))
+
+        def load(self):
+            import server
+            server.gmaps.directions = fake_directions
+            return server.app
+
+    Gunicorn().run()
+
+
+def run_server(mode, port):
+    if mode == 'gunicorn':
+        return run_gunicorn(port)
+    if mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+    import logging
+    import server
+    logging.disable(logging.CRITICAL)
+    server.gmaps.directions = fake_directions
+
+    if mode == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('127.0.0.1', port), server.app, log=None).serve_forever()
+    else:
+        # what `app.run` in server.py gives us
+        from werkzeug.serving import run_simple
+        run_simple('127.0.0.1', port, server.app, threaded=False)
+
+
+def call(port):
+    latlon = '{:.4f}, {:.4f}'.format(
+        random.uniform(-35, -30), random.uniform(115, 120)
+    )
+    req = Request(
+        'http://127.0.0.1:{}/location/payphone_found?{}'.format(
+            port, urlencode({'latlon': latlon})
+        ),
+        data=b'Digits=2'
+    )
+    with urlopen(req) as res:
+        res.read()
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen('http://127.0.0.1:{}/'.format(port)).read()
+            return
+        except URLError:
+            time.sleep(0.1)
+    raise RuntimeError('server on port {} never came up'.format(port))
+
+
+def bench(mode, port, calls, concurrency):
+    env = dict(DUMMY_AUTH, **os.environ)
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.concurrent_calls',
+         '--serve', mode, '--port', str(port)],
+        env=env, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_for(port)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda _: call(port), range(calls)))
+        return calls / (time.perf_counter() - start)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--port', type=int, default=5600)
+    parser.add_argument('--serve', choices=['sync', 'gevent', 'gunicorn'])
+    args = parser.parse_args()
+
+    if args.serve:
+        return run_server(args.serve, args.port)
+
+    print('{} calls, {} concurrent, {:.0f}ms backend latency'.format(
+        args.calls, args.concurrency, BACKEND_LATENCY * 1000
+    ))
+    for offset, mode in enumerate(['sync', 'gevent', 'gunicorn']):
+        throughput = bench(
+            mode, args.port + offset, args.calls, args.concurrency
+        )
+        print('{:>8}: {:8.1f} calls/s'.format(mode, throughput))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Keys pressed, Twilio round trips and rough time spent entering a cabinet
+id, for the staged flow against typing all nine digits up front.
+
+Every payphone in the local index (or, without one, a synthetic set of
+ids clustered by area and exchange like the real ones) is "called" once.
+
+    python3 -m benchmarks.digits
+"""
+import random
+
+from cabinets import ID_NUM_DIGITS, CabinetIds
+from payphones import PayPhoneIndex
+
+# rough costs of a key press and a webhook round trip, in seconds
+KEY_PRESS = 0.6
+ROUND_TRIP = 0.4
+
+
+def synthetic(count=20000, seed=1):
+    rand = random.Random(seed)
+    exchanges = [
+        '0{}{:03d}'.format(area, rand.randrange(1000))
+        for area in range(2, 9)
+        for _ in range(300)
+    ]
+    ids = set()
+    while len(ids) < count:
+        ids.add('{}{:03d}-{}'.format(
+            rand.choice(exchanges), rand.randrange(1000), rand.randrange(10)
+        ))
+    return [{'properties': {'CABINET_ID': id}} for id in sorted(ids)]
+
+
+def staged(cabinet_ids, digits):
+    """
+    (keys, round trips) for a caller at `digits` in the staged flow
+    """
+    prefix, gathers = '', 0
+    while True:
+        stage = cabinet_ids.next_stage(prefix)
+        prefix = digits[:len(prefix) + stage]
+        gathers += 1
+        if len(prefix) >= ID_NUM_DIGITS:
+            return len(prefix), gathers
+        if cabinet_ids.count(prefix) == 1:
+            # one press of hash to confirm
+            return len(prefix) + 1, gathers + 1
+
+
+def main():
+    index = PayPhoneIndex()
+    if index.is_fresh():
+        source, features = 'local index', list(index.features())
+    else:
+        source, features = 'synthetic ids', synthetic()
+    cabinet_ids = CabinetIds(features)
+
+    keys = gathers = 0
+    for digits in cabinet_ids.ids:
+        pressed, trips = staged(cabinet_ids, digits)
+        keys += pressed
+        gathers += trips
+    calls = len(cabinet_ids)
+
+    print('{} payphones ({})'.format(calls, source))
+    print('{:>10} {:>6} {:>12} {:>10}'.format(
+        'flow', 'keys', 'round trips', 'time (s)'
+    ))
+    for flow, pressed, trips in [
+        ('nine', ID_NUM_DIGITS, 1),
+        ('staged', keys / calls, gathers / calls),
+    ]:
+        print('{:>10} {:>6.2f} {:>12.2f} {:>10.2f}'.format(
+            flow, pressed, trips, pressed * KEY_PRESS + trips * ROUND_TRIP
+        ))
+    print('digits needed on average: {:.2f}'.format(
+        cabinet_ids.average_needed
+    ))
+
+
+if __name__ == '__main__':
+    main()
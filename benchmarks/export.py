@@ -0,0 +1,104 @@
+"""
+Time and peak memory of exporting the whole payphone table: the old
+one-page-at-a-time loop over features_by_sql against
+Table.iter_features with 1 and several workers.
+
+The FeatureService is faked in a separate process, with a fixed latency
+per page standing in for the mapinfo proxy.
+
+    python3 -m benchmarks.export [--count 20000] [--latency 0.2]
+"""
+import sys
+import time
+import argparse
+import subprocess
+import tracemalloc
+from urllib.request import urlopen
+from urllib.error import URLError
+
+import requests
+
+from payphones import ALL_PAYPHONES, FeatureService, Table
+
+PAGE_LENGTH = 1000
+
+
+def export_sequential(fs):
+    # what PayPhones.export_all did before iter_features
+    page = 1
+    while True:
+        features = fs.features_by_sql(
+            'select * from "{}"'.format(ALL_PAYPHONES),
+            pagenumber=page,
+            pageLength=PAGE_LENGTH
+        )['features']
+        yield from features
+        if len(features) < PAGE_LENGTH:
+            break
+        page += 1
+
+
+def measure(export):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = sum(1 for _ in export())
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, seconds, peak
+
+
+def wait_for(base, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen(base + '/tables/count').read()
+            return
+        except URLError:
+            time.sleep(0.1)
+    raise RuntimeError('fake FeatureService never came up')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--port', type=int, default=5650)
+    args = parser.parse_args()
+
+    proc = subprocess.Popen([
+        sys.executable, '-m', 'benchmarks.fake_backends',
+        '--count', str(args.count), '--latency', str(args.latency),
+        '--port', str(args.port)
+    ])
+    try:
+        fs = FeatureService(
+            'http://127.0.0.1:{}/FeatureService'.format(args.port)
+        )
+        # talk to the fake directly, not through the mapinfo proxy
+        fs.sess = requests.Session()
+        wait_for(fs.base)
+        table = Table(fs, ALL_PAYPHONES)
+
+        print('{} features, {} per page, {:.0f}ms per page'.format(
+            args.count, PAGE_LENGTH, args.latency * 1000
+        ))
+        for name, export in [
+            ('sequential', lambda: export_sequential(fs)),
+            ('iter_features, 1 worker',
+             lambda: table.iter_features(PAGE_LENGTH, workers=1)),
+            ('iter_features, 8 workers',
+             lambda: table.iter_features(PAGE_LENGTH, workers=8)),
+        ]:
+            count, seconds, peak = measure(export)
+            assert count == args.count, count
+            print('{:>26}: {:6.2f}s {:8.1f} MiB peak'.format(
+                name, seconds, peak / 2 ** 20
+            ))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+if __name__ == '__main__':
+    main()
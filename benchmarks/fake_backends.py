@@ -0,0 +1,124 @@
+"""
+Stand-ins for the remote backends, served over real HTTP on localhost,
+with injectable latency; for benchmarks and tests.
+"""
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def payphone(idx):
+    return {
+        'type': 'Feature',
+        'properties': {
+            'CABINET_ID': '{:08d}'.format(idx),
+            'SSC_Name': 'Suburb {}'.format(idx % 500),
+            'Latitude': -32 + (idx % 1000) / 100,
+            'Longitude': 115 + (idx // 1000) / 100,
+        },
+        'geometry': {'type': 'Point', 'coordinates': [115, -32]}
+    }
+
+
+class FakeFeatureService:
+    """
+    Serves a table of `count` payphones, taking `latency` seconds (or
+    whatever `latency()` returns) to answer each request.
+
+        with FakeFeatureService(count=5000) as fake:
+            fs = FeatureService(fake.base)
+    """
+
+    TABLES = [
+        '/telstrappol/NamedTables/TLS_All_Payphones',
+        '/telstrappol/NamedTables/TLS_payphone_locations',
+    ]
+
+    def __init__(self, count=1000, latency=0, port=0):
+        self.count = count
+        self.latency = latency
+        self.requests = []
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                fake.requests.append(self.path)
+                delay = fake.latency() if callable(fake.latency) \
+                    else fake.latency
+                time.sleep(delay)
+
+                body = json.dumps(fake.respond(
+                    url.path,
+                    {k: v[0] for k, v in parse_qs(url.query).items()}
+                )).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.base = 'http://127.0.0.1:{}/FeatureService'.format(
+            self.httpd.server_port
+        )
+
+    def respond(self, path, params):
+        if path.endswith('/features/count'):
+            return {'FeaturesTotalCount': self.count}
+        if path.endswith('/tables/count'):
+            return {'TablesTotalCount': len(self.TABLES)}
+        if path.endswith('/tables.json'):
+            return {'Tables': self.TABLES}
+        if path.endswith('/metadata.json'):
+            return {
+                'TableMetadata': {'name': path[:-len('/metadata.json')]},
+                'Metadata': [
+                    {'name': name, 'type': 'String'}
+                    for name in sorted(payphone(0)['properties'])
+                ]
+            }
+
+        page = int(params.get('page', 1))
+        page_length = int(params.get('pageLength', self.count))
+        start = (page - 1) * page_length
+        return {
+            'type': 'FeatureCollection',
+            'features': [
+                payphone(idx)
+                for idx in range(start, min(start + page_length, self.count))
+            ]
+        }
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a fake FeatureService')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    FakeFeatureService(args.count, args.latency, args.port).httpd \
+        .serve_forever()
+
+
+if __name__ == '__main__':
+    main()
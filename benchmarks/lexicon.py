@@ -0,0 +1,49 @@
+"""
+Throughput of Lexicon.normalize as the lexicon grows, on a long transit
+route. The real lexicon is padded out with made up abbreviations.
+
+    python3 -m benchmarks.lexicon
+"""
+import random
+import string
+import timeit
+
+from lexicon import Lexicon
+
+ROUTE = ' . '.join([
+    'Walk to Curtin Uni Stn Stand 3',
+    'Take the 98 from stop "Curtin Uni Stn", towards "Perth Busport" at '
+    '5:42pm, and disembark at "Albany Hwy Aft Welshpool Rd" after 25 mins',
+    'Head north on Farnham St toward Hayman Rd',
+    'Turn left onto Jarrah Rd . Destination will be on the right',
+] * 10)
+
+
+def lexicon_of(size, real):
+    rng = random.Random(size)
+    replacements = dict(list(real.replacements.items())[:size])
+    while len(replacements) < size:
+        abbreviation = rng.choice(string.ascii_uppercase) + ''.join(
+            rng.choice(string.ascii_lowercase)
+            for _ in range(rng.randint(1, 6))
+        )
+        replacements.setdefault(abbreviation, abbreviation.upper())
+    return Lexicon(replacements)
+
+
+def main():
+    real = Lexicon.load()
+    number = 500
+    print('{:>8} {:>12} {:>12}'.format('entries', 'us/route', 'MB/s'))
+    for size in [10, 1000, 10000]:
+        lexicon = lexicon_of(size, real)
+        seconds = min(timeit.repeat(
+            lambda: lexicon.normalize(ROUTE), number=number, repeat=3
+        )) / number
+        print('{:>8} {:>12.1f} {:>12.2f}'.format(
+            size, seconds * 1e6, len(ROUTE) / seconds / 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Time to turn Directions html_instructions into speech: the single pass
+tokenizer in server.parse_instruction against the lxml tree walk it
+replaced, over the corpus in instructions.json.
+
+    python3 -m benchmarks.parse_instruction
+"""
+import os
+import json
+import timeit
+import logging
+
+from lxml.html import fromstring
+
+import server
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'instructions.json')
+
+
+def parse_instruction_lxml(instruction):
+    # the previous implementation, for comparison
+    instruction = fromstring(instruction)
+    for inst in reversed(list(instruction.iter())):
+        if inst.text and inst.tag in {'p', 'div'}:
+            if inst.getchildren():
+                last = inst.getchildren()[-1]
+                if last.tail:
+                    last.tail += server.FULL_STOP
+                else:
+                    last.text += server.FULL_STOP
+            else:
+                inst.text += server.FULL_STOP
+
+    instruction = ''.join(instruction.itertext()).strip()
+    instruction = ' '.join(instruction.split())
+    instruction = instruction.replace('. .', '.')
+    return server.mend_short_place_names(instruction).strip()
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    with open(CORPUS) as fh:
+        corpus = [html for html, _ in json.load(fh)]
+
+    tokenizer = server.parse_instruction.__wrapped__
+    number = 500
+    for name, func in [
+        ('lxml', parse_instruction_lxml),
+        ('tokenizer', tokenizer),
+        ('tokenizer, memoized', server.parse_instruction),
+    ]:
+        seconds = min(timeit.repeat(
+            lambda: list(map(func, corpus)), number=number, repeat=3
+        ))
+        print('{:>20}: {:6.2f} us per instruction'.format(
+            name, seconds / number / len(corpus) * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Latency of live Directions calls while a burst of batch and prefetch work
+competes for the same quota, with the scheduler's priorities and with
+everything queued first come, first served.
+
+Google is faked with a fixed sleep, and the quota is scaled down so the
+burst saturates it.
+
+    python3 -m benchmarks.scheduler [--rate 20] [--burst-calls 200]
+"""
+import time
+import argparse
+import statistics
+import threading
+
+from scheduler import BATCH, LIVE, PREFETCH, Scheduler, Shed
+
+BACKEND_LATENCY = 0.05
+
+
+def fake_directions():
+    time.sleep(BACKEND_LATENCY)
+
+
+def run(rate, burst_calls, live_calls, prioritised):
+    scheduler = Scheduler('bench', rate, daily_budget=10 ** 6, burst=1)
+    for idx in range(burst_calls):
+        priority = BATCH if idx % 2 else PREFETCH
+        scheduler.submit(
+            priority if prioritised else LIVE, fake_directions
+        )
+
+    latencies = []
+
+    def live():
+        start = time.perf_counter()
+        try:
+            scheduler.call(LIVE, fake_directions)
+        except Shed:
+            return
+        latencies.append(time.perf_counter() - start)
+
+    threads = []
+    for _ in range(live_calls):
+        thread = threading.Thread(target=live)
+        thread.start()
+        threads.append(thread)
+        time.sleep(1 / rate)
+    for thread in threads:
+        thread.join()
+    return latencies, scheduler.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rate', type=float, default=20)
+    parser.add_argument('--burst-calls', type=int, default=200)
+    parser.add_argument('--live-calls', type=int, default=20)
+    args = parser.parse_args()
+
+    print('{:>12} {:>8} {:>8} {:>6} {:>6}'.format(
+        'queueing', 'p50 ms', 'p99 ms', 'live', 'shed'
+    ))
+    for prioritised in [False, True]:
+        latencies, stats = run(
+            args.rate, args.burst_calls, args.live_calls, prioritised
+        )
+        latencies.sort()
+        print('{:>12} {:>8.0f} {:>8.0f} {:>6} {:>6}'.format(
+            'priority' if prioritised else 'fifo',
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            len(latencies), sum(stats['shed'].values())
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Cold start cost of the app: how long `import server` takes according to
+`python -X importtime`, which modules it spends that on, and how long a
+fresh process takes to answer its first call.
+
+Exits with status 1 if the median import takes longer than the budget, so
+it can gate a build.
+
+    python3 -m benchmarks.startup [--runs 5] [--budget 300]
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+from benchmarks.concurrent_calls import DUMMY_AUTH
+
+# on a Heroku hobby dyno flask and requests alone are most of this
+IMPORT_BUDGET_MS = int(os.environ.get('IMPORT_BUDGET_MS', 300))
+FIRST_CALL = '''
+import time
+start = time.perf_counter()
+import server
+server.app.test_client().post('/location')
+print(time.perf_counter() - start)
+'''
+
+
+def run(args):
+    return subprocess.run(
+        [sys.executable] + args,
+        env=dict(DUMMY_AUTH, **os.environ),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True
+    )
+
+
+def import_times():
+    """
+    Cumulative microseconds per module for one `import server`
+    """
+    times = {}
+    stderr = run(['-X', 'importtime', '-c', 'import server']).stderr
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=int, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args()
+
+    runs = [import_times() for _ in range(args.runs)]
+    total = statistics.median(times['server'] for times in runs) / 1000
+    first_call = statistics.median(
+        float(run(['-c', FIRST_CALL]).stdout) for _ in range(args.runs)
+    ) * 1000
+
+    print('slowest imports (ms, median of {} runs):'.format(args.runs))
+    slowest = sorted(runs[0], key=runs[0].get, reverse=True)
+    top_level = [name for name in slowest if '.' not in name][:10]
+    for name in top_level:
+        print('  {:>8.1f}  {}'.format(
+            statistics.median(times.get(name, 0) for times in runs) / 1000,
+            name
+        ))
+    print('import server: {:.1f}ms (budget {}ms)'.format(total, args.budget))
+    print('first call:    {:.1f}ms'.format(first_call))
+
+    if total > args.budget:
+        print('over budget')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
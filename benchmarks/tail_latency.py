@@ -0,0 +1,67 @@
+"""
+Tail latency of remote cabinet id lookups against a fake FeatureService
+where a few requests stall, made directly and through the resilience
+layer's hedging.
+
+    python3 -m benchmarks.tail_latency [--lookups 300] [--stall-rate 0.05]
+"""
+import time
+import random
+import argparse
+
+import requests
+
+from payphones import FeatureService, PayPhones, PayPhoneIndex
+from resilience import Resilient
+from benchmarks.fake_backends import FakeFeatureService
+
+FAST = 0.02
+STALL = 1.0
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[int((len(values) - 1) * fraction)]
+
+
+def run(lookup, lookups):
+    latencies = []
+    for idx in range(lookups):
+        start = time.perf_counter()
+        lookup('{:08d}'.format(idx))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lookups', type=int, default=300)
+    parser.add_argument('--stall-rate', type=float, default=0.05)
+    args = parser.parse_args()
+
+    rand = random.Random(1)
+    with FakeFeatureService(count=1, latency=lambda: (
+            STALL if rand.random() < args.stall_rate else FAST)) as fake:
+        payphones = PayPhones(PayPhoneIndex('/nonexistent'))
+        payphones.fs = FeatureService(fake.base)
+        payphones.fs.sess = requests.Session()
+        payphones.remote = Resilient('featureservice')
+
+        print('{:>10} {:>8} {:>8} {:>8}'.format(
+            'lookups', 'p50 ms', 'p99 ms', 'max ms'
+        ))
+        for name, lookup in [
+            ('direct', payphones._remote_by_cabinet_id),
+            ('hedged', payphones.by_cabinet_id),
+        ]:
+            latencies = run(lookup, args.lookups)
+            print('{:>10} {:>8.0f} {:>8.0f} {:>8.0f}'.format(
+                name, percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000, max(latencies) * 1000
+            ))
+        print('requests sent: {}'.format(len(fake.requests)))
+        print(payphones.remote.stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Memory allocations and build time of a twiml.Response for routes of
+various lengths.
+
+"blocks" is the number of memory blocks still held by the finished
+response (roughly its object count), "peak" the most memory in use while
+building and rendering it.
+
+    python3 -m benchmarks.twiml_allocations
+"""
+import timeit
+import tracemalloc
+
+from twiml import Response
+
+STEP = 'Turn left onto Farnham Street . Destination will be on the right .'
+
+
+def build(steps):
+    res = Response()
+    for _ in range(steps):
+        res.say(STEP)
+        res.pause(length=1)
+    res.say('End of instructions')
+    with res.gather(numDigits=1, action='/possibly_repeat') as g:
+        g.say('Enter 1 to repeat instructions, or hang up.')
+    return res
+
+
+def measure(steps):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    res = build(steps)
+    res.toxml()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    del res
+    return blocks, peak
+
+
+def main():
+    number = 2000
+    print('{:>6} {:>8} {:>10} {:>10}'.format(
+        'steps', 'blocks', 'peak (B)', 'time (us)'
+    ))
+    for steps in [1, 10, 30]:
+        blocks, peak = measure(steps)
+        seconds = min(timeit.repeat(
+            lambda: build(steps).toxml(), number=number, repeat=3
+        ))
+        print('{:>6} {:>8} {:>10} {:>10.1f}'.format(
+            steps, blocks, peak, seconds / number * 1e6
+        ))
+
+
+if __name__ == '__main__':
+    main()
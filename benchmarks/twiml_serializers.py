@@ -0,0 +1,54 @@
+"""
+Render time of the lxml and string TwiML serializers, for responses the
+size of real walking and transit routes.
+
+    python3 -m benchmarks.twiml_serializers
+"""
+import timeit
+
+from twiml import Response
+
+STEP = (
+    'Take the 98 from stop "Curtin University Bus Station Stand 3", towards '
+    '"Perth Busport" at 5:42pm, and disembark at "Elizabeth Quay Bus '
+    'Station" after 25 minutes'
+)
+
+
+def route_response(serializer, steps):
+    res = Response(serializer)
+    for _ in range(steps):
+        res.say(STEP)
+        res.pause(length=1)
+    res.say('End of instructions')
+    action = '/possibly_repeat?latlon=1&Digits=2'
+    with res.gather(numDigits=1, action=action) as g:
+        g.say('Enter 1 to repeat instructions, or hang up.')
+    return res
+
+
+def main():
+    number = 2000
+    print('{:>6} {:>12} {:>12} {:>8}'.format(
+        'steps', 'lxml (us)', 'string (us)', 'speedup'
+    ))
+    for steps in [1, 5, 15, 30]:
+        timings = {}
+        for serializer in ['lxml', 'string']:
+            assert (
+                route_response(serializer, steps).toxml() ==
+                route_response('lxml', steps).toxml()
+            )
+            timings[serializer] = min(timeit.repeat(
+                lambda: route_response(serializer, steps).toxml(),
+                number=number, repeat=3
+            )) / number * 1e6
+
+        print('{:>6} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(
+            steps, timings['lxml'], timings['string'],
+            timings['lxml'] / timings['string']
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Cabinet id prefixes, so the payphone a caller is at can be settled as they
+type its id rather than after all nine digits.
+"""
+import re
+import threading
+from bisect import bisect_left
+from os.path import commonprefix
+from requests.structures import CaseInsensitiveDict
+
+from cache import LRUCache
+
+ID_NUM_DIGITS = 9
+# sorts after every digit, so prefix + END bounds every id with that prefix
+END = ':'
+
+
+def cabinet_digits(feature):
+    """
+    The digits of a feature's cabinet id, without its punctuation
+    """
+    properties = CaseInsensitiveDict(feature.get('properties') or {})
+    return re.sub(r'\D', '', str(properties.get('CABINET_ID') or ''))
+
+
+class CabinetIds:
+    """
+    Every cabinet id in the index, for the questions a prefix trie would
+    answer: which payphones a partly typed id could still be, and how many
+    more digits are worth asking for.
+
+    The ids are kept as a sorted list searched with bisect rather than as a
+    trie of nodes; the answers are the same, in a fraction of the memory.
+    """
+
+    def __init__(self, features, num_digits=ID_NUM_DIGITS):
+        pairs = sorted(
+            (cabinet_digits(feature), idx, feature)
+            for idx, feature in enumerate(features)
+        )
+        pairs = [pair for pair in pairs if pair[0]]
+        self.ids = [digits for digits, _, _ in pairs]
+        self.features = [feature for _, _, feature in pairs]
+        self.num_digits = num_digits
+
+        # how many digits tell each id apart from every other; ids sharing
+        # a prefix are neighbours once sorted, so only those are compared
+        self.needed = []
+        for idx, digits in enumerate(self.ids):
+            shared = max(
+                len(commonprefix([digits, self.ids[other]]))
+                for other in [idx - 1, idx + 1]
+                if 0 <= other < len(self.ids)
+            ) if len(self.ids) > 1 else 0
+            self.needed.append(min(shared + 1, num_digits))
+
+        self._stages = LRUCache(max_entries=4096)
+
+    def __repr__(self):
+        return '<CabinetIds of {} payphones>'.format(len(self))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _range(self, prefix):
+        return (
+            bisect_left(self.ids, prefix),
+            bisect_left(self.ids, prefix + END)
+        )
+
+    def count(self, prefix):
+        lo, hi = self._range(prefix)
+        return hi - lo
+
+    def matches(self, prefix):
+        lo, hi = self._range(prefix)
+        return self.features[lo:hi]
+
+    def next_stage(self, prefix):
+        """
+        How many more digits to gather after `prefix`: enough to settle at
+        least half of the payphones it could still be
+        """
+        stage = self._stages.get(prefix)
+        if stage is None:
+            lo, hi = self._range(prefix)
+            needed = sorted(self.needed[lo:hi])
+            target = needed[(len(needed) - 1) // 2] if needed \
+                else self.num_digits
+            stage = self._stages.set(
+                prefix,
+                min(max(target - len(prefix), 1),
+                    self.num_digits - len(prefix))
+            )
+        return stage
+
+    @property
+    def average_needed(self):
+        """
+        Digits a caller needs on average, if every stage were exactly long
+        enough
+        """
+        return sum(self.needed) / len(self.needed) if self.needed else 0
+
+
+class DigitStats:
+    """
+    How many digits, and how many round trips to Twilio, callers took to
+    identify their payphone.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = self.digits = self.gathers = 0
+
+    def record(self, digits, gathers):
+        with self._lock:
+            self.calls += 1
+            self.digits += digits
+            self.gathers += gathers
+
+    @property
+    def stats(self):
+        calls = self.calls or 1
+        return {
+            'calls': self.calls,
+            'average_digits': self.digits / calls,
+            'average_gathers': self.gathers / calls,
+        }
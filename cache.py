@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import OrderedDict, namedtuple
+
+Entry = namedtuple('Entry', 'value,expires,size')
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache with per-entry TTLs, bounded by both entry count
+    and a rough memory budget (the sizes callers attach to entries).
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, default_ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __repr__(self):
+        return '<LRUCache {} entries, {} bytes>'.format(len(self), self.size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    def get(self, key, default=None, count=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires is not None:
+                if entry.expires <= time.monotonic():
+                    self._remove(key)
+                    entry = None
+
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry.value
+
+    def set(self, key, value, ttl=None, size=0):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = Entry(value, expires, size)
+            self.size += size
+            self._evict()
+
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key).value
+
+    def clear(self):
+        """
+        Drop every entry, and start counting hits, misses and evictions
+        afresh
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        return entry
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or
+            (self.max_bytes is not None and self.size > self.max_bytes)
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        return {
+            'entries': len(self),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
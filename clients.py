@@ -0,0 +1,117 @@
+"""
+Shared, pooled HTTP sessions for the backends we talk to.
+
+Each backend gets one `requests.Session` for the life of the process, so
+connections (and their TLS handshakes) are kept alive and reused between
+calls, with its own pool size, timeouts and retry budget.
+"""
+import os
+import threading
+
+import requests
+from urllib3.util.retry import Retry
+
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+
+# (connect, read) timeouts in seconds, and how many times to retry
+BACKENDS = {
+    'featureservice': {'timeout': (3.05, 10), 'retries': 2},
+    'google': {'timeout': (3.05, 10), 'retries': 1},
+    'watson': {'timeout': (3.05, 30), 'retries': 1},
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PooledAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTPAdapter with a default timeout and a count of requests sent
+    against connections opened, so connection reuse can be checked.
+    """
+
+    def __init__(self, timeout=None, retries=0, pool_size=POOL_SIZE):
+        self.timeout = timeout
+        self.requests = self.connections = 0
+        self._stats_lock = threading.Lock()
+        super().__init__(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.1,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(['GET']),
+                raise_on_status=False
+            )
+        )
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: self._counting(pool_cls)
+            for scheme, pool_cls
+            in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def _counting(self, pool_cls):
+        adapter = self
+
+        class CountingPool(pool_cls):
+            def _new_conn(self):
+                with adapter._stats_lock:
+                    adapter.connections += 1
+                return super()._new_conn()
+
+        return CountingPool
+
+    def send(self, request, timeout=None, **kwargs):
+        with self._stats_lock:
+            self.requests += 1
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+    @property
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'connections_opened': self.connections,
+            'connections_reused': max(self.requests - self.connections, 0),
+        }
+
+
+def session(backend, adapter_cls=PooledAdapter):
+    """
+    The shared session for `backend`, one of BACKENDS
+    """
+    with _sessions_lock:
+        if backend not in _sessions:
+            config = BACKENDS[backend]
+            adapter = adapter_cls(
+                timeout=config['timeout'],
+                retries=config['retries']
+            )
+            sess = requests.Session()
+            sess.mount('https://', adapter)
+            sess.mount('http://', adapter)
+            _sessions[backend] = sess
+        return _sessions[backend]
+
+
+def reset_pools():
+    """
+    Drop every pooled connection; a forked child must not share sockets
+    with its parent
+    """
+    with _sessions_lock:
+        for sess in _sessions.values():
+            for adapter in sess.adapters.values():
+                adapter.poolmanager.clear()
+
+
+def pool_stats():
+    return {
+        backend: sess.get_adapter('https://').stats
+        for backend, sess in _sessions.items()
+    }
@@ -0,0 +1,102 @@
+"""
+Single-flight request coalescing: while a backend call for some key is in
+flight, callers asking for the same key wait for it and share its result
+instead of making their own.
+
+Waiting is done on threading primitives, so this works the same under
+plain threads and under gevent's monkey patched ones.
+"""
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = self.executed = self.saved = 0
+
+    def __repr__(self):
+        return '<SingleFlight "{}" {} in flight>'.format(
+            self.name, len(self._calls)
+        )
+
+    def join(self, key):
+        """
+        Returns `(future, leader)`. The leader must make the call and pass
+        its outcome to `finish`; everyone else waits on the future.
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self.saved += 1
+                return future, False
+
+            self.executed += 1
+            future = self._calls[key] = Future()
+            return future, True
+
+    def finish(self, key, result=None, exception=None):
+        with self._lock:
+            future = self._calls.pop(key)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call `func` unless a call for `key` is already in flight, in which
+        case wait for and return (or raise) its outcome
+        """
+        future, leader = self.join(key)
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.finish(key, exception=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    @property
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'executed': self.executed,
+            # backend calls that were avoided by sharing one in flight
+            'saved': self.saved,
+            'in_flight': len(self._calls),
+        }
+
+
+class Coalesced:
+    """
+    Wraps `target` so the named methods are coalesced on their arguments;
+    everything else is passed straight through.
+    """
+
+    def __init__(self, target, methods):
+        self._target = target
+        self._flights = {name: SingleFlight(name) for name in methods}
+
+    def __repr__(self):
+        return '<Coalesced {!r}>'.format(self._target)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        flight = self._flights.get(name)
+        if flight is None:
+            return attr
+
+        def coalesced(*args):
+            return flight.do(args, attr, *args)
+        return coalesced
+
+    @property
+    def stats(self):
+        return {name: flight.stats for name, flight in self._flights.items()}
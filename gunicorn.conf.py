@@ -0,0 +1,52 @@
+"""
+Production serving: a preforking gunicorn master with gevent workers.
+
+    gunicorn -c gunicorn.conf.py server:app
+
+The app is imported, and its payphone search and constant responses built,
+once in the master before any worker is forked, so every worker shares
+them copy-on-write. `kill -HUP <master>` replaces the workers gracefully,
+letting calls in progress finish first; since the app is preloaded, new
+code needs a full restart (or the USR2 binary upgrade dance).
+"""
+# patch before server (and its locks and sockets) is imported
+from gevent import monkey
+monkey.patch_all()
+
+import os
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 5555))
+# requests mostly wait on the network, which gevent overlaps within a
+# worker; one worker per core covers the CPU bound parts
+workers = int(os.environ.get('WEB_CONCURRENCY', available_cores()))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('MAX_CONNECTIONS', 1000))
+preload_app = True
+# Twilio gives up on a webhook after 15 seconds
+timeout = 30
+graceful_timeout = 30
+accesslog = None
+
+if workers > 1:
+    # calls hop between workers, so their state has to be shared
+    os.environ.setdefault('CALL_SESSIONS', 'sqlite:sessions.db')
+    # and each worker keeps to its share of the Google quota
+    os.environ.setdefault('GOOGLE_QUOTA_SHARES', str(workers))
+
+
+def when_ready(arbiter):
+    import server
+    server.preload()
+
+
+def post_fork(arbiter, worker):
+    import server
+    server.after_fork()
@@ -0,0 +1,62 @@
+"""
+Background jobs tied to a call, so a webhook can answer straight away and
+have Twilio come back for the result.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 8))
+# a call that hasn't come back for its job by now never will
+JOB_TTL = 5 * 60
+
+
+class JobTable:
+    """
+    At most one job per call, keyed by CallSid, run on a shared pool and
+    forgotten `ttl` seconds after it was started.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, ttl=JOB_TTL):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = LRUCache(max_entries=10000, default_ttl=ttl)
+        self._lock = threading.Lock()
+        self.started = self.reused = 0
+
+    def __repr__(self):
+        return '<JobTable {} jobs>'.format(len(self._jobs))
+
+    def start(self, call_sid, key, func, *args, **kwargs):
+        """
+        The future of `func` for this call; started now unless the call
+        already has a job for the same `key`, which replaces any other
+        """
+        with self._lock:
+            job = self._jobs.get(call_sid, count=False)
+            if job is not None and job[0] == key:
+                self.reused += 1
+                return job[1]
+
+            self.started += 1
+            future = self._executor.submit(func, *args, **kwargs)
+            self._jobs.set(call_sid, (key, future))
+            return future
+
+    def get(self, call_sid, key):
+        job = self._jobs.get(call_sid, count=False)
+        if job is None or job[0] != key:
+            return None
+        return job[1]
+
+    def clear(self):
+        self._jobs.clear()
+
+    @property
+    def stats(self):
+        return {
+            'jobs': len(self._jobs),
+            'started': self.started,
+            'reused': self.reused,
+        }
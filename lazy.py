@@ -0,0 +1,51 @@
+"""
+Backends built on first use rather than at import, so starting a process
+(and answering its first call) only pays for what that call needs.
+"""
+import threading
+
+
+class Lazy:
+    """
+    Stands in for whatever `factory` returns, calling it the first time an
+    attribute is needed.
+    """
+    __slots__ = ('_factory', '_target', '_lock')
+
+    def __init__(self, factory):
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_target', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def __repr__(self):
+        if self._target is None:
+            return '<Lazy {!r}, not yet built>'.format(self._factory)
+        return '<Lazy {!r}>'.format(self._target)
+
+    def _build(self):
+        target = self._target
+        if target is None:
+            with self._lock:
+                target = self._target
+                if target is None:
+                    target = self._factory()
+                    object.__setattr__(self, '_target', target)
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._build(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._build(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._build(), name)
+
+
+def resolve(obj):
+    """
+    The object behind `obj`, built now if it's Lazy and hasn't been yet
+    """
+    if isinstance(obj, Lazy):
+        return obj._build()
+    return obj
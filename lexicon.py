@@ -0,0 +1,109 @@
+import os
+import re
+
+LEXICON_PATH = os.environ.get(
+    'LEXICON',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lexicon.tsv')
+)
+# a name just before an abbreviation, or one starting just after it
+NAME_BEFORE = re.compile(r'[A-Z][\w\']* $')
+NAME_AFTER = re.compile(r' [A-Z]')
+
+
+class Lexicon:
+    """
+    Expands abbreviations (Rd -> Road, mins -> minutes) in text meant to be
+    spoken.
+
+    Every abbreviation is compiled into a single regex shaped like a trie of
+    their characters, so a whole route is rewritten in one pass, and the
+    work done at each position depends on how long the abbreviations are
+    rather than how many of them there are.
+
+    Abbreviations in `before_names` are expanded differently when they come
+    before a name rather than after one: "St Georges Tce" is Saint Georges
+    Terrace, but "Hay St" and "Hay St East" are streets.
+    """
+
+    def __init__(self, replacements, before_names=None):
+        self.replacements = dict(replacements)
+        self.before_names = dict(before_names or {})
+        self.regex = re.compile(
+            r'(?<!\w)(?:{})(?!\w)'.format(_trie_pattern(_trie(
+                self.replacements
+            )))
+            if self.replacements else
+            r'(?!)'
+        )
+
+    def __repr__(self):
+        return '<Lexicon of {} entries>'.format(len(self))
+
+    def __len__(self):
+        return len(self.replacements)
+
+    @classmethod
+    def load(cls, path=LEXICON_PATH):
+        """
+        Read tab separated abbreviation, expansion pairs, optionally
+        followed by the expansion before a name; blank lines and lines
+        starting with # are ignored
+        """
+        replacements, before_names = {}, {}
+        with open(path, encoding='utf-8') as fh:
+            for line in fh:
+                line = line.rstrip('\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                abbreviation, expansion, *before_name = line.split('\t')
+                replacements[abbreviation] = expansion
+                if before_name:
+                    before_names[abbreviation] = before_name[0]
+        return cls(replacements, before_names)
+
+    def _replace(self, match):
+        abbreviation = match.group()
+        before_name = self.before_names.get(abbreviation)
+        if before_name is not None \
+                and NAME_AFTER.match(match.string, match.end()) \
+                and not NAME_BEFORE.search(match.string, 0, match.start()):
+            return before_name
+        return self.replacements[abbreviation]
+
+    def normalize(self, text):
+        return self.regex.sub(self._replace, text)
+
+
+def _trie(words):
+    root = {}
+    for word in words:
+        node = root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    return root
+
+
+def _trie_pattern(node):
+    ends_here = '' in node
+    branches = [
+        re.escape(char) + _trie_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ''
+
+    if len(branches) == 1:
+        pattern = branches[0]
+        if not ends_here:
+            return pattern
+        grouped = len(branches[0]) > 1
+    else:
+        pattern = '|'.join(branches)
+        grouped = True
+
+    if grouped:
+        pattern = '(?:{})'.format(pattern)
+    # greedy, so the longest abbreviation is tried first
+    return pattern + '?' if ends_here else pattern
@@ -0,0 +1,182 @@
+"""
+Nearest payphone search over the local index, with numpy.
+"""
+import numpy as np
+from math import asin, cos, pi, radians, sin
+from requests.structures import CaseInsensitiveDict
+
+from payphones import NEAREST_MAX_FEATURES, NEAREST_WITHIN_KM
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine(lat, lon, lats, lons):
+    """
+    Great circle distance in kilometres, all coordinates in radians.
+    Broadcasts like any other numpy expression.
+    """
+    a = (
+        np.sin((lats - lat) / 2) ** 2 +
+        np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class NearestPayPhones:
+    """
+    In-process equivalent of the FeatureService searchNearest query.
+
+    Payphones are bucketed into a lat/lon grid; a query searches rings of
+    cells outwards from its own until nothing further out could be closer
+    than what it has already found.
+    """
+
+    def __init__(self, features, cell_size=0.25):
+        self.features = [
+            feature for feature in features
+            if _latlon(feature) is not None
+        ]
+        latlons = np.array(
+            [_latlon(feature) for feature in self.features],
+            dtype=float
+        ).reshape(-1, 2)
+        self.lats = np.radians(latlons[:, 0])
+        self.lons = np.radians(latlons[:, 1])
+        self.cell_size = cell_size
+        self.max_abs_lat = (
+            float(np.abs(latlons[:, 0]).max()) if len(latlons) else 0.0
+        )
+
+        cells = np.floor(latlons / cell_size).astype(int)
+        self.grid = {}
+        for idx, cell in enumerate(map(tuple, cells)):
+            self.grid.setdefault(cell, []).append(idx)
+        self.grid = {
+            cell: np.array(indices)
+            for cell, indices in self.grid.items()
+        }
+        if self.grid:
+            cell_ids = np.array(list(self.grid))
+            self._cell_min = cell_ids.min(axis=0)
+            self._cell_max = cell_ids.max(axis=0)
+
+    def __len__(self):
+        return len(self.features)
+
+    def _ring(self, centre, radius):
+        ci, cj = centre
+        if radius == 0:
+            yield centre
+            return
+        for j in range(cj - radius, cj + radius + 1):
+            yield (ci - radius, j)
+            yield (ci + radius, j)
+        for i in range(ci - radius + 1, ci + radius):
+            yield (i, cj - radius)
+            yield (i, cj + radius)
+
+    def _outside_bound(self, radius, lat):
+        # nothing outside the searched rings can be closer than this; the
+        # longitude term is the weaker one, so it alone is the bound
+        max_lat = radians(min(max(self.max_abs_lat, abs(lat)), 90))
+        return 2 * EARTH_RADIUS_KM * asin(
+            cos(max_lat) * sin(min(radians(radius * self.cell_size), pi) / 2)
+        )
+
+    def nearest(self, latlon, max_features=NEAREST_MAX_FEATURES,
+                within_km=NEAREST_WITHIN_KM):
+        if not self.grid:
+            return []
+
+        lat, lon = map(float, latlon)
+        rlat, rlon = radians(lat), radians(lon)
+        centre = (
+            int(np.floor(lat / self.cell_size)),
+            int(np.floor(lon / self.cell_size))
+        )
+        max_radius = int(max(
+            np.abs(self._cell_min - centre).max(),
+            np.abs(self._cell_max - centre).max()
+        ))
+
+        found, distances = [], []
+        for radius in range(max_radius + 1):
+            indices = [
+                self.grid[cell]
+                for cell in self._ring(centre, radius)
+                if cell in self.grid
+            ]
+            if indices:
+                indices = np.concatenate(indices)
+                found.append(indices)
+                distances.append(haversine(
+                    rlat, rlon, self.lats[indices], self.lons[indices]
+                ))
+
+            bound = self._outside_bound(radius, lat)
+            if bound > within_km:
+                break
+            if sum(map(len, found)) >= max_features:
+                kth = np.partition(
+                    np.concatenate(distances), max_features - 1
+                )[max_features - 1]
+                if kth <= bound:
+                    break
+
+        if not found:
+            return []
+        return self._results(
+            np.concatenate(found), np.concatenate(distances),
+            max_features, within_km
+        )
+
+    def nearest_many(self, latlons, max_features=NEAREST_MAX_FEATURES,
+                     within_km=NEAREST_WITHIN_KM, chunk_size=256):
+        """
+        Brute force equivalent of `nearest` for many points at once, for
+        bulk analytics; one distance matrix per chunk of queries.
+        """
+        latlons = np.radians(np.asarray(latlons, dtype=float).reshape(-1, 2))
+        indices = np.arange(len(self))
+        results = []
+        for start in range(0, len(latlons), chunk_size):
+            chunk = latlons[start:start + chunk_size]
+            matrix = haversine(
+                chunk[:, :1], chunk[:, 1:], self.lats, self.lons
+            )
+            results.extend(
+                self._results(indices, row, max_features, within_km)
+                for row in matrix
+            )
+        return results
+
+    def _results(self, indices, distances, max_features, within_km):
+        if len(distances) > max_features:
+            top = np.argpartition(distances, max_features - 1)
+            top = top[:max_features]
+        else:
+            top = np.arange(len(distances))
+        top = top[np.argsort(distances[top], kind='stable')]
+
+        results = []
+        for idx in top:
+            distance = float(distances[idx])
+            if distance > within_km:
+                break
+            feature = self.features[indices[idx]]
+            results.append(dict(
+                feature,
+                properties=dict(
+                    feature['properties'],
+                    distanceToFeature=distance
+                )
+            ))
+        return results
+
+
+def _latlon(feature):
+    properties = CaseInsensitiveDict(feature.get('properties') or {})
+    try:
+        return float(properties['Latitude']), float(properties['Longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
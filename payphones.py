@@ -1,10 +1,112 @@
+import os
+import re
 import json
-import requests
+import time
+import codecs
+import logging
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote_plus
-from functools import lru_cache
+from requests.structures import CaseInsensitiveDict
 
+from cabinets import CabinetIds
+from cache import LRUCache
+from clients import PooledAdapter, session
+from coalesce import SingleFlight
+from resilience import Resilient
 
-class ProxyAdapter(requests.adapters.HTTPAdapter):
+ALL_PAYPHONES = '/telstrappol/NamedTables/TLS_All_Payphones'
+INDEX_PATH = os.environ.get('PAYPHONE_INDEX', 'payphones.db')
+# rebuild at least weekly; payphones don't move very often
+INDEX_MAX_AGE = int(os.environ.get('PAYPHONE_INDEX_MAX_AGE', 7 * 24 * 60 * 60))
+EXPORT_PAGE_LENGTH = 1000
+# pages of an export fetched at once
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 4))
+# how long table listings, schemas and counts are trusted for
+METADATA_TTL = int(os.environ.get('FEATURESERVICE_METADATA_TTL', 60 * 60))
+_MISSING = object()
+NEAREST_MAX_FEATURES = 10
+NEAREST_WITHIN_KM = 1000
+
+
+_ARRAY_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def iter_json_array(chunks, key):
+    """
+    Yield the items of the array under `key` in a JSON document arriving
+    as `chunks` of bytes, one at a time, without holding the whole
+    document. `key` must not appear earlier in the document.
+    """
+    decoder = json.JSONDecoder()
+    start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(key)))
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf, pos = '', None
+
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        if pos is None:
+            match = start.search(buf)
+            if match is None:
+                continue
+            pos = match.end()
+
+        while True:
+            pos = _ARRAY_SEPARATOR.match(buf, pos).end()
+            if buf.startswith(']', pos):
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # not all here yet
+                break
+            yield item
+
+        buf, pos = buf[pos:], 0
+
+    raise ValueError('No complete "{}" array in response'.format(key))
+
+
+def fetch_features(sess, url, params):
+    """
+    One page of features, decoded as it is downloaded
+    """
+    with sess.get(url, params=params, stream=True) as res:
+        res.raise_for_status()
+        return list(iter_json_array(res.iter_content(64 * 1024), 'features'))
+
+
+def iter_pages(fetch_page, page_length, pages=None, workers=EXPORT_WORKERS):
+    """
+    Yield the features of pages 1, 2, ... in order, with up to `workers`
+    pages being fetched at once. Stops after `pages` pages or, when that
+    isn't known, after the first short page.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    in_flight = deque()
+    next_page = 1
+    try:
+        while True:
+            while len(in_flight) < workers and (
+                    pages is None or next_page <= pages):
+                in_flight.append(executor.submit(fetch_page, next_page))
+                next_page += 1
+            if not in_flight:
+                return
+
+            features = in_flight.popleft().result()
+            yield from features
+            if pages is None and len(features) < page_length:
+                return
+    finally:
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class ProxyAdapter(PooledAdapter):
     PROXY = 'http://services.mapinfo.com.au/localriaproxy?url='
 
     def send(self, prequest, **kwargs):
@@ -21,27 +123,32 @@ class Table:
     def __repr__(self):
         return '<Table "{}">'.format(self.name)
 
-    @lru_cache()
     def _metadata(self):
-        return self.fs.sess.get(self.url + '/metadata.json').json()
+        return self.fs.cached(
+            (self.name, 'metadata'),
+            lambda: self.fs.sess.get(self.url + '/metadata.json').json()
+        )
 
     @property
     def table_metadata(self):
         return self._metadata()['TableMetadata']
 
     @property
-    @lru_cache()
     def metadata(self):
         return {
-            meta.pop('name'): meta
+            meta['name']: {
+                key: val for key, val in meta.items() if key != 'name'
+            }
             for meta in self._metadata()['Metadata']
         }
 
-    @lru_cache()
     def __len__(self):
-        return self.fs.sess.get(
-            self.url + '/features/count'
-        ).json()['FeaturesTotalCount']
+        return self.fs.cached(
+            (self.name, 'count'),
+            lambda: self.fs.sess.get(
+                self.url + '/features/count'
+            ).json()['FeaturesTotalCount']
+        )
 
     def features(self, attributes=None, orderBy=None, query=None,
                  geometry: 'geom,srs'=None,
@@ -66,6 +173,22 @@ class Table:
             }
         ).json()
 
+    def iter_features(self, page_length=EXPORT_PAGE_LENGTH,
+                      workers=EXPORT_WORKERS, **params):
+        """
+        Every feature in the table (`params` as for the features.json
+        endpoint), fetched `workers` pages at a time. Only those pages are
+        ever held in memory.
+        """
+        pages = -(-len(self) // page_length)
+        return iter_pages(
+            lambda page: fetch_features(
+                self.fs.sess, self.url + '/features.json',
+                dict(params, page=page, pageLength=page_length)
+            ),
+            page_length, pages, workers
+        )
+
     def feature_by_id(self, id, attributes=None, locale=None):
         return self.fs.sess.get(
             self.url + '/features.json/{}'.format(id)
@@ -73,37 +196,80 @@ class Table:
 
 
 class FeatureService:
-    def __init__(self, base):
-        self.sess = requests.Session()
-        self.sess.mount('https://', ProxyAdapter())
-        self.sess.mount('http://', ProxyAdapter())
+    def __init__(self, base, metadata_ttl=METADATA_TTL):
+        self.sess = session('featureservice', ProxyAdapter)
         self.base = base
+        # table names, counts and schemas; see cached
+        self.metadata_cache = LRUCache(
+            max_entries=1024, default_ttl=metadata_ttl
+        )
+        self._fetches = SingleFlight('metadata')
+
+    def __repr__(self):
+        return '<FeatureService "{}">'.format(self.base)
+
+    def cached(self, key, fetch):
+        """
+        The result of `fetch()`, kept under `key` for the metadata TTL
+        """
+        value = self.metadata_cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._fetches.do(key, fetch)
+            self.metadata_cache.set(
+                key, value, size=len(json.dumps(value))
+            )
+        return value
+
+    def invalidate(self, table=None):
+        """
+        Forget the cached metadata of `table`, or of everything
+        """
+        if table is None:
+            self.metadata_cache.clear()
+            return
+        for kind in ['metadata', 'count']:
+            self.metadata_cache.pop((table, kind))
+
+    def warm(self, tables=()):
+        """
+        Fetch the table listing, and the schema and count of `tables`,
+        ahead of the first call that needs them. Failures are only logged.
+        """
+        try:
+            self.table_names
+            for name in tables:
+                table = Table(self, name)
+                table.metadata
+                len(table)
+        except Exception:
+            logging.exception('Could not warm FeatureService metadata')
 
-    @lru_cache()
     def __len__(self):
-        return self.sess.get(
-            self.base + '/tables/count'
-        ).json()["TablesTotalCount"]
+        return self.cached(
+            'table_count',
+            lambda: self.sess.get(
+                self.base + '/tables/count'
+            ).json()["TablesTotalCount"]
+        )
+
+    @property
+    def table_names(self):
+        return self.cached(
+            'table_names',
+            lambda: self.sess.get(self.base + '/tables.json').json()["Tables"]
+        )[:]
 
     @property
-    @lru_cache()
     def tables(self):
-        names = self.sess.get(self.base + '/tables.json').json()["Tables"]
         return [
             Table(self, name)
-            for name in names
+            for name in self.table_names
         ]
 
-    @lru_cache()
-    def _table_lookup(self):
-        return {table.name: table for table in self.tables}
-
     def get_table(self, name):
-        return self._table_lookup()[name]
-
-    @property
-    def table_names(self):
-        return list(self._table_lookup().keys())
+        if name not in self.table_names:
+            raise KeyError(name)
+        return Table(self, name)
 
     def features(self, **kwargs):
         return self.sess.get(
@@ -119,21 +285,191 @@ class FeatureService:
             pageLength=pageLength
         )
 
+    def iter_features(self, sql, count=None, locale=None,
+                      page_length=EXPORT_PAGE_LENGTH, workers=EXPORT_WORKERS):
+        """
+        Every feature matched by `sql`, as Table.iter_features. Without the
+        `count` of matches, pages are fetched until one comes back short.
+        """
+        return iter_pages(
+            lambda page: fetch_features(
+                self.sess, self.base + '/tables/features.json',
+                {
+                    'q': sql,
+                    'l': locale,
+                    'page': page,
+                    'pageLength': page_length
+                }
+            ),
+            page_length,
+            None if count is None else -(-count // page_length),
+            workers
+        )
+
+
+class PayPhoneIndex:
+    """
+    Local SQLite copy of the TLS_All_Payphones table, keyed by cabinet id.
+
+    Answers the same LIKE patterns as the remote FeatureService, without
+    the round trip through the mapinfo proxy.
+    """
+
+    def __init__(self, path=INDEX_PATH, max_age=INDEX_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '<PayPhoneIndex "{}">'.format(self.path)
+
+    def _stat(self):
+        try:
+            return os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+    def _connect(self, stat):
+        # reconnect if the index file has been rebuilt underneath us
+        if getattr(self._local, 'inode', None) != stat.st_ino:
+            conn = sqlite3.connect(self.path)
+            # lets LIKE 'prefix%x' use the cabinet_id index
+            conn.execute('PRAGMA case_sensitive_like = ON')
+            self._local.conn = conn
+            self._local.inode = stat.st_ino
+        return self._local.conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = self._local.inode = None
+
+    def exists(self):
+        return self._stat() is not None
+
+    def is_fresh(self):
+        stat = self._stat()
+        return stat is not None and time.time() - stat.st_mtime < self.max_age
+
+    def by_cabinet_id(self, cabinet_id):
+        rows = self._connect(os.stat(self.path)).execute(
+            'select feature from payphones where cabinet_id like ?',
+            (cabinet_id,)
+        )
+        return [json.loads(feature) for feature, in rows]
+
+    def build(self, features):
+        """
+        Replace the index contents with the given features, atomically.
+        """
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+        conn = sqlite3.connect(tmp_path)
+        with conn:
+            conn.execute(
+                'create table payphones '
+                '(cabinet_id text not null, feature text not null)'
+            )
+            conn.executemany(
+                'insert into payphones values (?, ?)',
+                (
+                    (
+                        str(CaseInsensitiveDict(
+                            feature['properties']
+                        )['CABINET_ID']),
+                        json.dumps(feature, separators=(',', ':'))
+                    )
+                    for feature in features
+                )
+            )
+            conn.execute(
+                'create index payphones_cabinet_id on payphones (cabinet_id)'
+            )
+            count, = conn.execute('select count(*) from payphones').fetchone()
+        conn.close()
+
+        os.replace(tmp_path, self.path)
+        logging.info('Built payphone index of %d payphones', count)
+        return count
+
+    def features(self):
+        rows = self._connect(os.stat(self.path)).execute(
+            'select feature from payphones'
+        )
+        return (json.loads(feature) for feature, in rows)
+
 
 class PayPhones:
-    def __init__(self):
+    def __init__(self, index=None):
         # NOTE: not actually localhost, as it goes through a proxy
         self.fs = FeatureService(
             'http://localhost:8080/rest/Spatial/FeatureService'
         )
+        self.index = index or PayPhoneIndex()
+        self.remote = Resilient('featureservice')
+        # name: (index mtime, built from it); see _from_index
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+
+    def export_all(self, page_length=EXPORT_PAGE_LENGTH,
+                   workers=EXPORT_WORKERS):
+        return Table(self.fs, ALL_PAYPHONES).iter_features(
+            page_length, workers
+        )
+
+    def build_index(self):
+        return self.index.build(self.export_all())
+
+    def _from_index(self, name, build):
+        """
+        `build(features)` of the local index, rebuilt whenever the index
+        is. None if the index isn't usable.
+        """
+        if not self.index.is_fresh():
+            return None
+
+        mtime = os.stat(self.index.path).st_mtime
+        with self._derived_lock:
+            built_for, built = self._derived.get(name, (None, None))
+            if built_for != mtime:
+                built = build(self.index.features())
+                self._derived[name] = (mtime, built)
+        return built
+
+    def nearest(self):
+        """
+        The in-process nearest payphone search
+        """
+        def build(features):
+            # numpy is only needed here, so only imported here
+            from nearest import NearestPayPhones
+            return NearestPayPhones(features)
+        return self._from_index('nearest', build)
+
+    def cabinet_ids(self):
+        """
+        Every cabinet id, for settling a payphone from part of its id
+        """
+        return self._from_index('cabinet_ids', CabinetIds)
 
     def by_latlon(self, latlon):
+        nearest = self.nearest()
+        if nearest is not None:
+            return {
+                'type': 'FeatureCollection',
+                'features': nearest.nearest(latlon)
+            }
+
+        logging.info('Payphone index missing or stale, querying remote')
         table = self.fs.get_table(
             '/telstrappol/NamedTables/TLS_payphone_locations'
         )
 
         return table.features(
-            maxFeatures='10',
+            maxFeatures=str(NEAREST_MAX_FEATURES),
             geometry=json.dumps(
                 {
                     "type": "Point",
@@ -144,16 +480,37 @@ class PayPhones:
                     }
                 }
             ),
-            withinDistance='1000 km',
+            withinDistance='{} km'.format(NEAREST_WITHIN_KM),
             q='searchNearest',
             distanceAttributeName='distanceToFeature'
         )
 
     def by_cabinet_id(self, cabinet_id):
+        if self.index.is_fresh():
+            return self.index.by_cabinet_id(cabinet_id)
+
+        logging.info('Payphone index missing or stale, querying remote')
+        return self.remote.call(
+            self._remote_by_cabinet_id, cabinet_id,
+            # a stale index beats keeping the caller waiting
+            fallback=lambda: self._stale_by_cabinet_id(cabinet_id)
+        )
+
+    def _remote_by_cabinet_id(self, cabinet_id):
         return self.fs.features_by_sql(
             'select * '
-            'from "/telstrappol/NamedTables/TLS_All_Payphones" '
+            'from "{}" '
             'where CABINET_ID '
             'like (\'{}\')'
-            .format(cabinet_id)
+            .format(ALL_PAYPHONES, cabinet_id)
         )['features']
+
+    def _stale_by_cabinet_id(self, cabinet_id):
+        if self.index.exists():
+            return self.index.by_cabinet_id(cabinet_id)
+        return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    PayPhones().build_index()
@@ -0,0 +1,104 @@
+"""
+Batch job precomputing spoken walking instructions from every payphone to
+ADDRESSTO, so the live endpoint never has to ask Google for them.
+
+Only routes that are missing or older than the store's max age are
+fetched, unless --full is given. At most --budget Directions requests
+are made per run; routes past that are left for the next run.
+"""
+import logging
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from requests.structures import CaseInsensitiveDict
+
+from scheduler import BATCH, BUDGET_RESERVE
+from server import (
+    ADDRESSTO, GOOGLE_DAILY_BUDGET, format_lat_lon, gmaps, google_scheduler,
+    payphone_client, quantize_lat_lon, route_instructions, route_store
+)
+
+
+def payphone_origins():
+    return {
+        quantize_lat_lon(format_lat_lon(
+            CaseInsensitiveDict(feature['properties'])
+        ))
+        for feature in payphone_client.index.features()
+    }
+
+
+def walking_instructions(origin):
+    directions_result = google_scheduler.call(
+        BATCH,
+        gmaps.directions,
+        origin,
+        ADDRESSTO,
+        mode='walking',
+        departure_time=datetime.now()
+    )
+    if not directions_result:
+        return None
+    return route_instructions(directions_result[0])
+
+
+def precompute(concurrency=4, full=False, budget=GOOGLE_DAILY_BUDGET):
+    # batch work stops its reserve short of the scheduler's limit, and
+    # this process has no live callers to keep it for
+    google_scheduler.budget.limit = budget / (1 - BUDGET_RESERVE[BATCH])
+    origins = payphone_origins()
+    pruned = route_store.prune(ADDRESSTO, origins)
+
+    if not full:
+        origins -= route_store.fresh_origins(ADDRESSTO)
+
+    logging.info(
+        'Fetching %d walking routes, pruned %d', len(origins), pruned
+    )
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(walking_instructions, origin): origin
+            for origin in origins
+        }
+        for future in as_completed(futures):
+            origin = futures[future]
+            try:
+                instructions = future.result()
+            except Exception:
+                logging.exception('Failed to fetch route from %s', origin)
+                failed += 1
+                continue
+
+            if instructions is not None:
+                route_store.put(origin, ADDRESSTO, instructions)
+
+    logging.info(
+        'Done, %d failed, %d over budget', failed,
+        google_scheduler.stats['shed']['batch']
+    )
+    return len(origins) - failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument(
+        '--full', action='store_true',
+        help='recompute every route, not just missing or expired ones'
+    )
+    parser.add_argument(
+        '--budget', type=int, default=GOOGLE_DAILY_BUDGET,
+        help='most Directions requests this run may make; every run '
+             'counts from zero (default %(default)s)'
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    precompute(args.concurrency, args.full, args.budget)
+
+
+if __name__ == '__main__':
+    main()
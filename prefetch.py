@@ -0,0 +1,85 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 4))
+# more than this many prefetches in flight and new ones are dropped
+PREFETCH_MAX_PENDING = int(os.environ.get('PREFETCH_MAX_PENDING', 32))
+# how long an unclaimed result is kept for
+PREFETCH_TTL = 2 * 60
+
+
+class Prefetcher:
+    """
+    Runs work speculatively in the background, so a later request for the
+    same key can pick up the finished (or at least started) result.
+    """
+
+    def __init__(self, workers=PREFETCH_WORKERS,
+                 max_pending=PREFETCH_MAX_PENDING, ttl=PREFETCH_TTL):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._futures = LRUCache(max_entries=1024, default_ttl=ttl)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.submitted = self.shed = self.hidden = self.waited = 0
+
+    def __repr__(self):
+        return '<Prefetcher {} pending>'.format(self.pending)
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Start `func` for `key` unless it already has been, or too much is
+        already in flight. Returns whether it was started.
+        """
+        with self._lock:
+            if key in self._futures:
+                return False
+            if self.pending >= self.max_pending:
+                self.shed += 1
+                logging.info('Shedding prefetch of %s', key)
+                return False
+            self.pending += 1
+            self.submitted += 1
+            future = self._executor.submit(func, *args, **kwargs)
+            self._futures.set(key, future)
+
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+        if future.exception() is not None:
+            logging.warning('Prefetch failed: %r', future.exception())
+
+    def take(self, key):
+        """
+        The future prefetched for `key`, if there is one; it is only
+        handed out once.
+        """
+        future = self._futures.pop(key)
+        if future is None:
+            return None
+
+        with self._lock:
+            if future.done():
+                self.hidden += 1
+            else:
+                self.waited += 1
+        return future
+
+    @property
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'submitted': self.submitted,
+            'shed': self.shed,
+            # finished before they were asked for; all latency hidden
+            'hidden': self.hidden,
+            # still running when asked for; some latency hidden
+            'waited': self.waited,
+        }
@@ -0,0 +1,223 @@
+"""
+Latency budgets for calls to slow backends: a call is hedged with a
+duplicate once it has taken longer than most do, abandoned (falling back
+to local data where there is some) once it has used up its budget, and
+not made at all while the backend's circuit breaker is open.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+)
+
+# seconds a live call can spend on each backend before we give up on it
+LATENCY_BUDGETS = {
+    'featureservice': float(os.environ.get('FEATURESERVICE_BUDGET', 2.5)),
+    'google': float(os.environ.get('GOOGLE_BUDGET', 3)),
+}
+# hedge calls still running after this percentile of recent latencies
+HEDGE_PERCENTILE = 0.95
+# until there are this many latencies, hedge at half the budget
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+RESILIENCE_WORKERS = int(os.environ.get('RESILIENCE_WORKERS', 16))
+# consecutive failures (or calls over budget) that open a breaker, and
+# how long it stays open before letting a trial call through
+BREAKER_FAILURES = 5
+BREAKER_RESET = 30
+
+
+class CircuitOpen(Exception):
+    """
+    The backend has been failing, so the call wasn't made
+    """
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half open'
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset=BREAKER_RESET,
+                 clock=time.monotonic):
+        self.name = name
+        self.max_failures = failures
+        self.reset = reset
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<CircuitBreaker "{}" {}>'.format(self.name, self.state)
+
+    def allow(self):
+        """
+        Whether a call may go ahead; once open, a single trial call is let
+        through every `reset` seconds
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    self.clock() - self._opened >= self.reset:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.max_failures:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    logging.warning('Circuit breaker %s open', self.name)
+                self.state = self.OPEN
+                self._opened = self.clock()
+
+
+class Resilient:
+    """
+    Makes calls to one backend within its latency budget. Only for calls
+    that are safe to make twice. Hedges are only sent while `hedge_if()`,
+    if given, is true.
+    """
+
+    def __init__(self, name, budget=None, workers=RESILIENCE_WORKERS,
+                 breaker=None, hedge_if=None):
+        self.name = name
+        self.budget = budget or LATENCY_BUDGETS[name]
+        self.breaker = breaker or CircuitBreaker(name)
+        self.hedge_if = hedge_if
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys([
+            'calls', 'hedged', 'hedge_won', 'hedge_skipped', 'over_budget',
+            'failed', 'short_circuited', 'fallbacks'
+        ], 0)
+
+    def __repr__(self):
+        return '<Resilient "{}" {}s>'.format(self.name, self.budget)
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _percentile(self, fraction):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[int((len(latencies) - 1) * fraction)]
+
+    def hedge_delay(self):
+        delay = self._percentile(HEDGE_PERCENTILE)
+        return self.budget / 2 if delay is None else delay
+
+    def _worth_hedging(self, deadline):
+        if self.hedge_if is not None and not self.hedge_if():
+            return False
+        # a hedge that would typically land after the deadline can't win,
+        # as when most calls take longer than the budget anyway
+        typical = self._percentile(0.5) or 0
+        return deadline - time.monotonic() > typical
+
+    def _timed(self, func, args, kwargs):
+        start = time.monotonic()
+        result = func(*args, **kwargs)
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+        return result
+
+    def call(self, func, *args, fallback=None, **kwargs):
+        """
+        `func(*args, **kwargs)`, or if that fails, runs over budget or
+        the breaker is open, `fallback()`. Without a fallback the error
+        (TimeoutError when over budget) is raised.
+        """
+        self._count('calls')
+        if not self.breaker.allow():
+            self._count('short_circuited')
+            return self._fall_back(fallback, CircuitOpen(self.name))
+
+        try:
+            result = self._hedged(func, args, kwargs)
+        except TimeoutError as e:
+            self._count('over_budget')
+            self.breaker.failed()
+            return self._fall_back(fallback, e)
+        except Exception as e:
+            self._count('failed')
+            self.breaker.failed()
+            return self._fall_back(fallback, e)
+        self.breaker.succeeded()
+        return result
+
+    def _hedged(self, func, args, kwargs):
+        deadline = time.monotonic() + self.budget
+        first = self._executor.submit(self._timed, func, args, kwargs)
+        attempts = [first]
+
+        hedge_at = min(self.hedge_delay(), self.budget)
+        done, _ = wait(attempts, timeout=hedge_at)
+        if not done and not self._worth_hedging(deadline):
+            self._count('hedge_skipped')
+        elif not done:
+            self._count('hedged')
+            attempts.append(
+                self._executor.submit(self._timed, func, args, kwargs)
+            )
+
+        error = None
+        pending = set(attempts)
+        while pending:
+            done, pending = wait(
+                pending, timeout=max(deadline - time.monotonic(), 0),
+                return_when=FIRST_COMPLETED
+            )
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self._count('hedge_won')
+                    return future.result()
+                error = future.exception()
+
+        if pending:
+            # the stragglers finish in the background, unwatched
+            raise TimeoutError('{} over its {}s budget'.format(
+                self.name, self.budget
+            ))
+        raise error
+
+    def _fall_back(self, fallback, error):
+        if fallback is None:
+            raise error
+        logging.warning('Falling back from %s: %r', self.name, error)
+        result = fallback()
+        if result is None:
+            raise error
+        self._count('fallbacks')
+        return result
+
+    @property
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        return dict(
+            counts,
+            breaker=self.breaker.state,
+            breaker_trips=self.breaker.trips,
+            hedge_delay=self.hedge_delay(),
+        )
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+ROUTES_PATH = os.environ.get('ROUTE_STORE', 'routes.db')
+# walking routes barely change, but footpaths and closures do eventually
+ROUTES_MAX_AGE = int(os.environ.get('ROUTE_STORE_MAX_AGE', 30 * 24 * 60 * 60))
+
+
+class RouteStore:
+    """
+    Precomputed spoken walking instructions, keyed by quantized origin and
+    destination. Filled by precompute.py, read by the live endpoint.
+    """
+
+    def __init__(self, path=ROUTES_PATH, max_age=ROUTES_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '<RouteStore "{}">'.format(self.path)
+
+    def _connect(self, create=False):
+        if getattr(self._local, 'conn', None) is None:
+            if not create and not os.path.exists(self.path):
+                return None
+            conn = sqlite3.connect(self.path)
+            conn.execute(
+                'create table if not exists routes ('
+                'origin text not null, '
+                'destination text not null, '
+                'instructions text not null, '
+                'fetched_at real not null, '
+                'primary key (origin, destination))'
+            )
+            self._local.conn = conn
+        return self._local.conn
+
+    def get(self, origin, destination):
+        conn = self._connect()
+        if conn is None:
+            return None
+
+        row = conn.execute(
+            'select instructions from routes '
+            'where origin = ? and destination = ? and fetched_at > ?',
+            (origin, destination, time.time() - self.max_age)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def fresh_origins(self, destination):
+        rows = self._connect(create=True).execute(
+            'select origin from routes '
+            'where destination = ? and fetched_at > ?',
+            (destination, time.time() - self.max_age)
+        )
+        return {origin for origin, in rows}
+
+    def put(self, origin, destination, instructions):
+        conn = self._connect(create=True)
+        with conn:
+            conn.execute(
+                'insert or replace into routes values (?, ?, ?, ?)',
+                (
+                    origin, destination,
+                    json.dumps(instructions, separators=(',', ':')),
+                    time.time()
+                )
+            )
+
+    def prune(self, destination, keep):
+        """
+        Drop routes to `destination` from origins no longer in `keep`, and
+        any to other destinations.
+        """
+        conn = self._connect(create=True)
+        stale = [
+            (origin, dest)
+            for origin, dest in conn.execute(
+                'select origin, destination from routes'
+            )
+            if dest != destination or origin not in keep
+        ]
+        with conn:
+            conn.executemany(
+                'delete from routes where origin = ? and destination = ?',
+                stale
+            )
+        return len(stale)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,286 @@
+"""
+Priority scheduling of calls against a rate limited, metered API, so
+background work never takes quota a live caller needs.
+
+Work is queued by priority and started by a single dispatcher as the token
+bucket allows, so whenever a token frees up it goes to the most urgent
+call waiting. When the queue is full, or the day's budget is running low,
+the least urgent work is shed first; live calls are never shed for the
+budget.
+"""
+import os
+import time
+import heapq
+import logging
+import threading
+from datetime import date
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LIVE, PREFETCH, BATCH = range(3)
+PRIORITY_NAMES = {LIVE: 'live', PREFETCH: 'prefetch', BATCH: 'batch'}
+
+SCHEDULER_WORKERS = int(os.environ.get('SCHEDULER_WORKERS', 8))
+SCHEDULER_MAX_QUEUED = int(os.environ.get('SCHEDULER_MAX_QUEUED', 64))
+# share of the daily budget each priority leaves for the ones above it
+BUDGET_RESERVE = {LIVE: 0, PREFETCH: 0.1, BATCH: 0.25}
+
+
+class Shed(Exception):
+    """
+    The call was dropped to make room for more urgent work
+    """
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls a second on average, and bursts of up to `burst`
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<TokenBucket {}/s>'.format(self.rate)
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def try_take(self):
+        """
+        Take a token if there is one, otherwise return how many seconds
+        until there will be
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def take(self):
+        wait = self.try_take()
+        while wait:
+            time.sleep(wait)
+            wait = self.try_take()
+
+
+class DailyBudget:
+    """
+    Counts calls against a limit that resets at midnight, local time
+    """
+
+    def __init__(self, limit, today=date.today):
+        self.limit = limit
+        self.today = today
+        self._day = today()
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<DailyBudget {}/{}>'.format(self.used, self.limit)
+
+    def _rollover(self):
+        today = self.today()
+        if today != self._day:
+            self._day, self.used = today, 0
+
+    def spend(self, reserve=0, force=False):
+        """
+        Count a call, unless it would leave less than `reserve` of the
+        budget unspent (or `force`d to anyway). Returns whether it was
+        within budget.
+        """
+        with self._lock:
+            self._rollover()
+            within = self.used + 1 <= self.limit * (1 - reserve)
+            if within or force:
+                self.used += 1
+            return within
+
+    @property
+    def remaining(self):
+        with self._lock:
+            self._rollover()
+            return max(self.limit - self.used, 0)
+
+
+class Scheduler:
+    """
+    Runs calls against one API in priority order, within its rate limit and
+    daily budget. `call` blocks for the result, `submit` returns a future.
+    Calls given a `key` can later be `promote`d if something more urgent
+    comes to depend on them.
+    """
+
+    def __init__(self, name, rate, daily_budget, burst=None,
+                 workers=SCHEDULER_WORKERS, max_queued=SCHEDULER_MAX_QUEUED):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.budget = DailyBudget(daily_budget)
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # taken before a call leaves the queue, so nothing waits for a
+        # worker in the executor's own first come, first served queue
+        self._workers = threading.Semaphore(workers)
+        self._queue = []
+        self._keyed = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._dispatcher = None
+        self.run = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.shed = dict.fromkeys(PRIORITY_NAMES, 0)
+
+    def __repr__(self):
+        return '<Scheduler "{}" {} queued>'.format(self.name, len(self))
+
+    def __len__(self):
+        return sum(1 for entry in self._queue if entry[3] is not None)
+
+    def call(self, priority, func, *args, **kwargs):
+        return self.submit(priority, func, *args, **kwargs).result()
+
+    def submit(self, priority, func, *args, key=None, **kwargs):
+        future = Future()
+        job = (future, func, args, kwargs, key)
+        with self._cond:
+            if len(self) >= self.max_queued and not self._evict(priority):
+                self._shed(priority, future, 'queue full')
+                return future
+
+            entry = self._push(priority, job)
+            if key is not None:
+                self._keyed[key] = entry
+            self._start()
+            self._cond.notify()
+        return future
+
+    def promote(self, key, priority):
+        """
+        Move the queued call for `key` up to `priority`; returns whether
+        there was one to move
+        """
+        with self._cond:
+            entry = self._keyed.get(key)
+            if entry is None or entry[3] is None or entry[0] <= priority:
+                return False
+            job, entry[3] = entry[3], None
+            self._keyed[key] = self._push(priority, job)
+            self._cond.notify()
+            return True
+
+    def _push(self, priority, job):
+        self._seq += 1
+        # a list so a queued call can be cancelled in place, by emptying it
+        entry = [priority, self._seq, job[4], job]
+        heapq.heappush(self._queue, entry)
+        return entry
+
+    def _evict(self, priority):
+        """
+        Shed the least urgent queued call to make room for one at
+        `priority`, if any is less urgent than it
+        """
+        queued = [entry for entry in self._queue if entry[3] is not None]
+        if not queued:
+            return False
+        victim = max(queued, key=lambda entry: entry[:2])
+        if victim[0] <= priority:
+            return False
+        job, victim[3] = victim[3], None
+        self._forget(job[4], victim)
+        self._shed(victim[0], job[0], 'evicted')
+        return True
+
+    def _forget(self, key, entry):
+        if key is not None and self._keyed.get(key) is entry:
+            del self._keyed[key]
+
+    def _shed(self, priority, future, reason):
+        self.shed[priority] += 1
+        logging.info(
+            'Shedding %s %s call: %s',
+            PRIORITY_NAMES[priority], self.name, reason
+        )
+        future.set_exception(Shed('{} {}'.format(self.name, reason)))
+
+    def _start(self):
+        # started on first use, so each forked worker gets its own
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            self._dispatcher = threading.Thread(
+                target=self._dispatch, name='{}-scheduler'.format(self.name),
+                daemon=True
+            )
+            self._dispatcher.start()
+
+    def _queued(self):
+        # drops cancelled entries off the top of the heap
+        while self._queue and self._queue[0][3] is None:
+            heapq.heappop(self._queue)
+        return bool(self._queue)
+
+    def _dispatch(self):
+        while True:
+            # wait for work, a free worker and a token, then pick whatever
+            # is most urgent by the time they came through
+            with self._cond:
+                while not self._queued():
+                    self._cond.wait()
+            self._workers.acquire()
+            self.bucket.take()
+            with self._cond:
+                if not self._queued():
+                    self._workers.release()
+                    continue
+                entry = heapq.heappop(self._queue)
+                priority, _, key, job = entry
+                self._forget(key, entry)
+
+            # a live caller would only get the error prompt, so they are
+            # let through over budget, and only background work is shed
+            if not self.budget.spend(BUDGET_RESERVE[priority],
+                                     force=priority == LIVE):
+                if priority != LIVE:
+                    self._workers.release()
+                    self._shed(priority, job[0], 'over daily budget')
+                    continue
+                logging.warning('%s over its daily budget', self.name)
+            self.run[priority] += 1
+            try:
+                self._executor.submit(self._run, job)
+            except RuntimeError:
+                # the interpreter is shutting down
+                self._shed(priority, job[0], 'shutting down')
+                return
+
+    def _run(self, job):
+        future, func, args, kwargs, _ = job
+        try:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        finally:
+            self._workers.release()
+
+    @property
+    def stats(self):
+        return {
+            'queued': len(self),
+            'run': {PRIORITY_NAMES[p]: n for p, n in self.run.items()},
+            'shed': {PRIORITY_NAMES[p]: n for p, n in self.shed.items()},
+            'budget_used': self.budget.used,
+            'budget_remaining': self.budget.remaining,
+        }
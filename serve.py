@@ -0,0 +1,40 @@
+"""
+Cooperative serving mode: every request runs in a greenlet, and the
+standard library is monkey patched so the FeatureService, Directions and
+Watson calls (all plain `requests`) yield while they wait on the network.
+The handlers themselves are unchanged.
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import logging
+import threading
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from auth import ON_HEROKU
+from server import PRESYNTHESIZE, app, warm_prompts
+
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', 1000))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    if PRESYNTHESIZE:
+        threading.Thread(target=warm_prompts, daemon=True).start()
+
+    port = int(os.environ['PORT']) if ON_HEROKU else 5555
+    server = WSGIServer(
+        ('0.0.0.0', port), app,
+        spawn=Pool(MAX_CONNECTIONS),
+        log=None
+    )
+    logging.info('Serving on port %d', port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,43 +2,199 @@ import re
 import os
 import hmac
 import json
+import time
 import logging
-import requests
+import threading
 from hashlib import sha1
-from functools import wraps
+from html import unescape
+from functools import lru_cache, wraps
 from base64 import b64encode
 from datetime import datetime
+from concurrent.futures import TimeoutError
 from urllib.parse import urlencode
 from requests.structures import CaseInsensitiveDict
 
-import googlemaps
-from flask import url_for, Flask, request, Response as FlaskResponse
-from lxml.html import fromstring
+from flask import (
+    url_for, Flask, request, send_file, Response as FlaskResponse
+)
 import humanize
 
-from twiml import Response
+from twiml import Constant, Response, Template, WatsonSay
+from cache import LRUCache
 from auth import AUTH, ON_HEROKU
-from payphones import PayPhones
+from clients import BACKENDS, reset_pools, session
+from routes import RouteStore
+from lexicon import Lexicon
+from sessions import session_store
+from prefetch import Prefetcher
+from coalesce import Coalesced, SingleFlight
+from lazy import Lazy, resolve
+from cabinets import ID_NUM_DIGITS, DigitStats
+from jobs import JobTable
+from scheduler import LIVE, PREFETCH, Scheduler
+from resilience import Resilient
+from tts import (
+    AudioCache, MIMETYPE, VOICE, prerendered_name, prerendered_names,
+    presynthesize, synthesize
+)
 
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.DEBUG)
 
-payphone_client = PayPhones()
-gmaps = googlemaps.Client(key=AUTH['GOOGLE_MAPS_DIRECTIONS'])
 
-ID_NUM_DIGITS = 9
+def payphones_client():
+    from payphones import PayPhones
+    return Coalesced(PayPhones(), ['by_cabinet_id'])
+
+
+def google_client():
+    import googlemaps
+    client = googlemaps.Client(
+        key=AUTH['GOOGLE_MAPS_DIRECTIONS'],
+        connect_timeout=BACKENDS['google']['timeout'][0],
+        read_timeout=BACKENDS['google']['timeout'][1]
+    )
+    client.session = session('google')
+    return client
+
+
+# built when first used, see lazy.py
+payphone_client = Lazy(payphones_client)
+gmaps = Lazy(google_client)
+lexicon = Lazy(Lexicon.load)
+call_sessions = Lazy(session_store)
+audio_cache = Lazy(AudioCache)
+route_store = RouteStore()
+prefetcher = Prefetcher()
+directions_flights = SingleFlight('directions')
+speech_flights = SingleFlight('speech')
+digit_stats = DigitStats()
+directions_jobs = JobTable()
+# our Directions quota: queries a second, and a day; counted per process,
+# so gunicorn.conf.py has it split between the workers
+GOOGLE_QUOTA_SHARES = int(os.environ.get('GOOGLE_QUOTA_SHARES', 1))
+GOOGLE_QPS = float(os.environ.get('GOOGLE_QPS', 10)) / GOOGLE_QUOTA_SHARES
+GOOGLE_DAILY_BUDGET = int(
+    os.environ.get('GOOGLE_DAILY_BUDGET', 2500)
+) // GOOGLE_QUOTA_SHARES
+google_scheduler = Scheduler('google', GOOGLE_QPS, GOOGLE_DAILY_BUDGET)
+# a hedge behind a backlog only adds to it
+google_calls = Resilient(
+    'google', hedge_if=lambda: len(google_scheduler) == 0
+)
+prerendered_prompts = prerendered_names()
+
 ADDRESSTO = os.environ.get('ADDRESSTO', '6c Farnham Street, Bentley')
 FULL_STOP = ' . '
-REPLACEMENTS = {
-    'Stn': 'Station',
-    'Ave': 'Avenue',
-    'Rd': 'Road',
-    'Sq': 'Square'
-}
-REPLACEMENT_RE = re.compile(
-    r'(\W|^)({})(\W|$)'.format('|'.join(REPLACEMENTS))
+EASTER_EGG_DIGITS = ''.join(map(str, range(1, ID_NUM_DIGITS+1)))
+BLOCK_TAGS = {'p', 'div'}
+HTML_TOKEN_RE = re.compile(r'</?(?P<tag>\w*)[^>]*>|(?P<text>[^<]+)')
+# decimal places kept of the origin; 4 is roughly 10 metres
+DIRECTIONS_PRECISION = int(os.environ.get('DIRECTIONS_PRECISION', 4))
+WALKING_TTL = int(os.environ.get('WALKING_TTL', 24 * 60 * 60))
+# no route is often only for now (no transit running, a blip at Google)
+NO_ROUTE_TTL = int(os.environ.get('NO_ROUTE_TTL', 60))
+# transit results are shared by callers departing within the same bucket
+TRANSIT_BUCKET = int(os.environ.get('TRANSIT_BUCKET', 5 * 60))
+directions_cache = LRUCache(
+    max_entries=int(os.environ.get('DIRECTIONS_CACHE_ENTRIES', 4096)),
+    max_bytes=int(os.environ.get('DIRECTIONS_CACHE_BYTES', 64 * 1024 * 1024))
+)
+# the last walking directions from each origin, for when Google can't
+# answer a live caller in time; never transit, whose departures go stale
+stale_directions = LRUCache(max_entries=4096, default_ttl=24 * 60 * 60)
+# cached audio is content addressed, so it never goes stale
+SPEECH_MAX_AGE = 365 * 24 * 60 * 60
+# how long payphone_found waits on Google before putting the caller on
+# hold, and how long they can be held before we give up
+HOLD_AFTER = float(os.environ.get('HOLD_AFTER', 0.05))
+HOLD_TIMEOUT = 30
+# steps read out per TwiML document, so long routes start playing sooner
+ROUTE_PAGE_STEPS = int(os.environ.get('ROUTE_PAGE_STEPS', 5))
+# seconds to wait for a key press before carrying on to the next page
+ROUTE_PAGE_TIMEOUT = 1
+# gather the id in stages, settled against the local index; off by default
+# as it costs callers more round trips than it saves them digits
+STAGED_ID_ENTRY = bool(os.environ.get('STAGED_ID_ENTRY'))
+# render the fixed prompts to static/speech/ at boot
+PRESYNTHESIZE = bool(os.environ.get('PRESYNTHESIZE'))
+# longest to wait on another caller's synthesis of the same text; also
+# covers a stream that is never read, so its waiters are never told
+SPEECH_WAIT = 30
+LOCATION_PROMPT = (
+    'Please enter the {} digit payphone identification number'
+    .format(humanize.apnumber(ID_NUM_DIGITS))
 )
+MODE_PROMPT = (
+    'Please enter, 1 for walking instructions, or 2 for public '
+    'transportation instructions'
+)
+INVALID_ID_PROMPT = 'Invalid eye d number'
+NOT_FOUND_PROMPT = 'Payphone could not be found'
+INVALID_SUBURB_PROMPT = 'Invalid suburb selection'
+SELECTED_PROMPT = 'Selected payphone'
+CONFIRM_PROMPT = (
+    'Press hash to confirm, or keep entering the identification number'
+)
+INVALID_INPUT_PROMPT = 'Invalid input'
+NO_ROUTES_PROMPT = 'No routes could be found'
+END_OF_INSTRUCTIONS_PROMPT = 'End of instructions'
+HOLD_PROMPT = 'Please hold while we find your route'
+CONTINUE_PROMPT = 'Press 1 to continue'
+MORE_DIGITS_PROMPT = 'Next digits please'
+REPEAT_PROMPT = 'Enter 1 to repeat instructions, or hang up.'
+ERROR_PROMPT = "I'm sorry, something seems to have gone wrong. Goodbye"
+GOODBYE_PROMPT = 'Okay, goodbye'
+# every prompt that doesn't depend on the call, for pre-synthesis
+STATIC_PROMPTS = [
+    LOCATION_PROMPT, MODE_PROMPT, INVALID_ID_PROMPT, NOT_FOUND_PROMPT,
+    INVALID_SUBURB_PROMPT, SELECTED_PROMPT, INVALID_INPUT_PROMPT,
+    NO_ROUTES_PROMPT, END_OF_INSTRUCTIONS_PROMPT, REPEAT_PROMPT,
+    CONTINUE_PROMPT, MORE_DIGITS_PROMPT, ERROR_PROMPT, GOODBYE_PROMPT
+]
+
+
+def hangup_with(prompt):
+    return Constant(lambda: Response().say(prompt).hangup())
+
+
+INVALID_ID_RESPONSE = hangup_with(INVALID_ID_PROMPT)
+NOT_FOUND_RESPONSE = hangup_with(NOT_FOUND_PROMPT)
+INVALID_SUBURB_RESPONSE = hangup_with(INVALID_SUBURB_PROMPT)
+INVALID_INPUT_RESPONSE = hangup_with(INVALID_INPUT_PROMPT)
+NO_ROUTES_RESPONSE = hangup_with(NO_ROUTES_PROMPT)
+ERROR_RESPONSE = hangup_with(ERROR_PROMPT)
+GOODBYE_RESPONSE = hangup_with(GOODBYE_PROMPT)
+EASTER_EGG_RESPONSE = Constant(
+    lambda: Response().play(
+        '/static/Gorillaz%20-%20Film%20Music%20(Official%20Visual).mp3'
+    ).hangup()
+)
+LOCATION_RESPONSE = Constant(lambda: location_response())
+HOLD_RESPONSE = Constant(
+    lambda: Response().say(HOLD_PROMPT).redirect(url_for('route_ready'))
+)
+STILL_HOLDING_RESPONSE = Constant(
+    lambda: Response().pause(length=1).redirect(url_for('route_ready'))
+)
+PAYPHONE_FOUND_RESPONSE = Template(
+    lambda suburb, action: mode_menu(
+        Response().say('Payphone found in {}'.format(suburb)),
+        action
+    ),
+    text=['suburb'],
+    attributes=['action']
+)
+PAYPHONE_CONFIRM_RESPONSE = Template(
+    lambda suburb, remaining, action: confirm_response(
+        suburb, remaining, action
+    ),
+    text=['suburb'],
+    attributes=['remaining', 'action']
+)
+# first gather of the staged flow, by how many digits it asks for
+STAGED_LOCATION_RESPONSES = {}
 TRANSIT_STEP_TEMPLATE = (
     'Take the {route_name} from stop "{departure_stop}", towards "{towards}" '
     'at {departure_time}, and disembark at "{arrival_stop}" after {duration}'
@@ -49,7 +205,10 @@ def twiml(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         res = func(*args, **kwargs)
-        return FlaskResponse(res.toxml(), mimetype='text/xml')
+        response = FlaskResponse(res.toxml(), mimetype='text/xml')
+        if isinstance(res, Constant):
+            response.set_etag(res.etag)
+        return response
     return wrapper
 
 
@@ -57,23 +216,190 @@ def params_and_url_for(endpoint, params):
     return url_for(endpoint) + '?' + urlencode(params)
 
 
+def remember(**fields):
+    """
+    Keep `fields` in this call's session, if Twilio told us which call this
+    is. Returns whether they were kept; if not, they have to be passed
+    along in the callback url instead.
+    """
+    call_sid = request.values.get('CallSid')
+    if call_sid is None:
+        return False
+    call_sessions.update(call_sid, **fields)
+    return True
+
+
+def recall(key):
+    call_sid = request.values.get('CallSid')
+    if call_sid is None:
+        return None
+    return call_sessions.get(call_sid).get(key)
+
+
+def stateful_url_for(endpoint, **params):
+    if remember(**params):
+        return url_for(endpoint)
+    return params_and_url_for(endpoint, params)
+
+
+def speech_url_for(text):
+    name = prerendered_name(text)
+    if name in prerendered_prompts:
+        return url_for('static', filename='speech/' + name)
+    return params_and_url_for('speech', {'text': text})
+
+
+WatsonSay.url_for = speech_url_for
+
+
+def warm_prompts():
+    prerendered_prompts.update(presynthesize(STATIC_PROMPTS))
+    # and whatever other workers rendered meanwhile
+    prerendered_prompts.update(prerendered_names())
+
+
+def preload():
+    """
+    Do the one-off setup each worker would otherwise repeat: build the
+    backends, load the nearest payphone search and render the constant
+    responses. Run before forking, so workers share the results
+    copy-on-write.
+    """
+    for backend in [payphone_client, gmaps, lexicon, call_sessions,
+                    audio_cache]:
+        resolve(backend)
+    payphone_client.nearest()
+    if STAGED_ID_ENTRY:
+        payphone_client.cabinet_ids()
+    with app.test_request_context():
+        for value in list(globals().values()):
+            if isinstance(value, Constant):
+                value.etag
+        PAYPHONE_FOUND_RESPONSE.render(suburb='', action='')
+        PAYPHONE_CONFIRM_RESPONSE.render(suburb='', remaining=1, action='')
+
+
+def after_fork():
+    """
+    Drop the SQLite connections and sockets a worker inherited from the
+    process that forked it, then warm the worker's FeatureService metadata
+    (and prompts, with PRESYNTHESIZE) in the background
+    """
+    payphone_client.index.close()
+    route_store.close()
+    call_sessions.close()
+    reset_pools()
+
+    # not in preload: the master shouldn't wait on the FeatureService, nor
+    # open connections to it before forking
+    from payphones import ALL_PAYPHONES
+    threading.Thread(
+        target=payphone_client.fs.warm, args=([ALL_PAYPHONES],), daemon=True
+    ).start()
+    if PRESYNTHESIZE:
+        threading.Thread(target=warm_prompts, daemon=True).start()
+
+
+@app.teardown_appcontext
+def close_connections(exc=None):
+    """
+    Close the SQLite connections this request opened. The stores keep one
+    per thread, and under gevent's monkey patching a thread is a greenlet,
+    so kept past the request each would be left open for good.
+    """
+    payphone_client.index.close()
+    route_store.close()
+    call_sessions.close()
+
+
 @app.route('/location/id_recieved', methods=['POST'])
 @twiml
 def id_recieved():
+    digit_stats.record(len(request.form['Digits']), 1)
     return id_recieved_response(request.form['Digits'])
 
 
-def id_recieved_response(digits):
+@app.route('/location/id_digits', methods=['POST'])
+@twiml
+def id_digits():
+    if 'prefix' in request.args:
+        prefix = request.args['prefix']
+        gathers = int(request.args['gathers'])
+    else:
+        prefix, gathers = recall('prefix'), recall('gathers')
+        if prefix is None:
+            # the session is gone; start again
+            return location()
+
+    return id_digits_response(
+        prefix, gathers, request.values.get('Digits', '')
+    )
+
+
+def id_digits_response(prefix, gathers, digits):
+    """
+    One stage of the staged id entry: `prefix` is what was typed in earlier
+    stages, `digits` what was typed in this one
+    """
+    logging.info('Digits: "%s" after "%s"', digits, prefix)
+    if not re.match(r'\d*$', digits):
+        return INVALID_ID_RESPONSE
+
+    cabinet_ids = payphone_client.cabinet_ids()
+    if not digits and cabinet_ids is not None \
+            and cabinet_ids.count(prefix) == 1:
+        # the caller confirmed the only payphone it could be
+        digit_stats.record(len(prefix), gathers)
+        properties = CaseInsensitiveDict(
+            cabinet_ids.matches(prefix)[0]['properties']
+        )
+        return do_for_payphone(Response(), format_lat_lon(properties))
+
+    prefix += digits
+    if cabinet_ids is None or len(prefix) >= ID_NUM_DIGITS:
+        digit_stats.record(len(prefix), gathers)
+        return id_recieved_response(prefix)
+
+    count = cabinet_ids.count(prefix)
+    if count == 0 and not EASTER_EGG_DIGITS.startswith(prefix):
+        return NOT_FOUND_RESPONSE
+
+    action = stateful_url_for('id_digits', prefix=prefix, gathers=gathers + 1)
+    if count == 1:
+        properties = CaseInsensitiveDict(
+            cabinet_ids.matches(prefix)[0]['properties']
+        )
+        prefetch_directions(format_lat_lon(properties))
+        return PAYPHONE_CONFIRM_RESPONSE.render(
+            suburb=properties['SSC_Name'],
+            remaining=ID_NUM_DIGITS - len(prefix),
+            action=action
+        )
+
     res = Response()
+    with res.gather(numDigits=cabinet_ids.next_stage(prefix),
+                    action=action) as g:
+        g.say(MORE_DIGITS_PROMPT)
+    return res
+
+
+def confirm_response(suburb, remaining, action):
+    res = Response()
+    with res.gather(numDigits=remaining, action=action, finishOnKey='#',
+                    actionOnEmptyResult='true') as g:
+        g.say('Payphone found in {}'.format(suburb))
+        g.say(CONFIRM_PROMPT)
+    return res
+
+
+def id_recieved_response(digits):
     logging.info('Digits: "%s"', digits)
 
     if not re.match(r'\d{%d}' % ID_NUM_DIGITS, digits):
-        return res.say('Invalid eye d number').hangup()
+        return INVALID_ID_RESPONSE
 
-    if digits == ''.join(map(str, range(1, ID_NUM_DIGITS+1))):
-        return res.play(
-            '/static/Gorillaz%20-%20Film%20Music%20(Official%20Visual).mp3'
-        ).hangup()
+    if digits == EASTER_EGG_DIGITS:
+        return EASTER_EGG_RESPONSE
 
     # insert a wildcard where the punctuation is in the phone id
     payphone_id = digits[:-1] + '%' + digits[-1]
@@ -85,29 +411,34 @@ def id_recieved_response(digits):
         for payphone in payphones
     ]
     if not payphones:
-        return res.say('Payphone could not be found').hangup()
+        return NOT_FOUND_RESPONSE
 
     if len(payphones) > 1:
         return select_from_payphones(payphones)
     else:
         properties = CaseInsensitiveDict(payphones[0])
-        message = 'Payphone found in {}'.format(properties['SSC_Name'])
-        res.say(message)
-        logging.info(message)
-        return do_for_payphone(res, format_lat_lon(properties))
+        logging.info('Payphone found in %s', properties['SSC_Name'])
+        latlon = format_lat_lon(properties)
+        prefetch_directions(latlon)
+        return PAYPHONE_FOUND_RESPONSE.render(
+            suburb=properties['SSC_Name'],
+            action=payphone_found_action(latlon)
+        )
 
 
 def select_from_payphones(payphones):
     res = Response()
-    action = params_and_url_for(
-        'select_payphone_suburb',
-        {
-            'phones': json.dumps([
-                format_lat_lon(payphone)
-                for payphone in payphones
-            ])
-        }
-    )
+    phones = [
+        format_lat_lon(payphone)
+        for payphone in payphones
+    ]
+    if remember(phones=phones):
+        action = url_for('select_payphone_suburb')
+    else:
+        action = params_and_url_for(
+            'select_payphone_suburb',
+            {'phones': json.dumps(phones)}
+        )
 
     with res.gather(numDigits=1, action=action) as g:
         g.say(
@@ -131,48 +462,44 @@ format_lat_lon = '{Latitude}, {Longitude}'.format_map
 @app.route('/select_payphone_suburb', methods=['POST'])
 @twiml
 def select_payphone_suburb():
+    payphones = recall('phones')
+    if payphones is None:
+        payphones = json.loads(request.args['phones'])
+
     return select_payphone_suburb_response(
         int(request.form['Digits']),
-        json.loads(request.args['phones'])
+        payphones
     )
 
 
 def select_payphone_suburb_response(idx, payphones):
-    res = Response()
-
     try:
         payphone = payphones[idx - 1]  # we 1 index for useability
     except IndexError:
-        return res.say('Invalid suburb selection').hangup()
+        return INVALID_SUBURB_RESPONSE
 
     logging.info('Selected payphone at latlon %s', payphone)
 
-    res.say('Selected payphone')
+    res = Response()
+    res.say(SELECTED_PROMPT)
 
     return do_for_payphone(res, payphone)
 
 
-def do_for_payphone(res, latlon):
-    action = params_and_url_for(
-        'payphone_found',
-        {'latlon': latlon}
-    )
+def payphone_found_action(latlon):
+    return stateful_url_for('payphone_found', latlon=latlon)
 
+
+def mode_menu(res, action):
     with res.gather(numDigits=1, action=action) as g:
-        g.say(
-            'Please enter, 1 for walking instructions, or 2 for public '
-            'transportation instructions'
-        )
+        g.say(MODE_PROMPT)
 
     return res
 
 
-def _replace_part(match):
-    return '{}{}{}'.format(
-        match.group(1),
-        REPLACEMENTS[match.group(2)],
-        match.group(3)
-    )
+def do_for_payphone(res, latlon):
+    prefetch_directions(latlon)
+    return mode_menu(res, payphone_found_action(latlon))
 
 
 def checksum(url, incoming, auth_token):
@@ -216,42 +543,82 @@ def only_from_twilio(func):
 @app.route('/speech', methods=['GET', 'POST'])
 @only_from_twilio
 def speech():
-    mimetype = 'audio/wav'
-
-    res = requests.get(
-        'https://stream.watsonplatform.net/text-to-speech/api/v1/synthesize',
-        params={
-            'text': request.values['text'],
-            'accept': mimetype,
-            'voice': 'en-US_AllisonVoice'
-        },
-        auth=(AUTH['SPEECH_USERNAME'], AUTH['SPEECH_PASSWORD']),
-        stream=True
-    )
+    text = request.values['text']
+    key = audio_cache.key(text, VOICE, MIMETYPE)
+
+    path = audio_cache.get(key)
+    leader = False
+    if path is None:
+        future, leader = speech_flights.join(key)
+        if not leader:
+            # being synthesized for another caller; serve their copy
+            try:
+                path = future.result(timeout=SPEECH_WAIT)
+            except Exception:
+                logging.warning('Shared synthesis failed, synthesizing')
+
+    if path is not None:
+        return send_file(
+            path,
+            mimetype=MIMETYPE,
+            etag=key,
+            max_age=SPEECH_MAX_AGE,
+            conditional=True
+        )
 
-    return FlaskResponse(res.raw, mimetype=mimetype)
+    try:
+        res = synthesize(text)
+    except Exception as e:
+        if leader:
+            speech_flights.finish(key, exception=e)
+        raise
+    if not res.ok:
+        if leader:
+            speech_flights.finish(key)
+        return FlaskResponse(res.raw, status=res.status_code,
+                             mimetype=MIMETYPE)
+
+    chunks = audio_cache.write_through(key, res.iter_content(64 * 1024))
+    response = FlaskResponse(chunks, mimetype=MIMETYPE)
+    response.set_etag(key)
+    response.cache_control.public = True
+    response.cache_control.max_age = SPEECH_MAX_AGE
+    if leader:
+        # hand the cached file (None if the stream was cut short) to
+        # callers who asked for the same speech meanwhile; on close, so
+        # it happens even if the body is never read
+        response.call_on_close(
+            lambda: speech_flights.finish(key, audio_cache.get(key))
+        )
+    return response
 
 
+@lru_cache(maxsize=4096)
 def parse_instruction(instruction):
-    # strip out html tags
-
-    instruction = fromstring(instruction)
-    for inst in reversed(list(instruction.iter())):
-        if inst.text and inst.tag in {'p', 'div'}:
-            if inst.getchildren():
-                last = inst.getchildren()[-1]
-                if last.tail:
-                    last.tail += FULL_STOP
-                else:
-                    last.text += FULL_STOP
-            else:
-                inst.text += FULL_STOP
-
-    # convert XML tree to plain string
-    instruction = ''.join(instruction.itertext()).strip()
+    # convert the html to plain text in one pass over its tags, with a
+    # full stop wherever a block element starts or ends
+    parts = []
+    pending_stop = False
+    for match in HTML_TOKEN_RE.finditer(instruction):
+        text = match.group('text')
+        if text is None:
+            if match.group('tag').lower() in BLOCK_TAGS:
+                pending_stop = True
+            continue
+
+        if '&' in text:
+            text = unescape(text)
+        if not text.isspace():
+            if pending_stop and parts:
+                parts.append(FULL_STOP)
+            pending_stop = False
+        parts.append(text)
+
+    if parts:
+        parts.append(FULL_STOP)
 
     # remove excess whitespace
-    instruction = ' '.join(instruction.split())
+    instruction = ' '.join(''.join(parts).split())
 
     # mend weird pattern
     instruction = instruction.replace('. .', '.')
@@ -265,8 +632,8 @@ def parse_instruction(instruction):
 
 def mend_short_place_names(instruction):
     # replace short versions of address parts with their full versions
-    # ie, Stn -> Station
-    return REPLACEMENT_RE.sub(_replace_part, instruction)
+    # ie, Stn -> Station, as well as units, ie mins -> minutes
+    return lexicon.normalize(instruction)
 
 
 @app.route('/location/payphone_found', methods=['POST'])
@@ -274,14 +641,13 @@ def mend_short_place_names(instruction):
 def payphone_found():
     return payphone_found_response(
         request.values['Digits'],
-        request.args['latlon']
+        request.args.get('latlon') or recall('latlon')
     )
 
 
 def payphone_found_response(digits, from_):
-    res = Response()
     if digits not in {'1', '2'}:
-        return res.say('Invalid input').hangup()
+        return INVALID_INPUT_RESPONSE
 
     mode = {'1': 'walking', '2': 'transit'}[digits]
 
@@ -296,53 +662,307 @@ def payphone_found_response(digits, from_):
         mode
     )
 
-    directions_result = gmaps.directions(
-        from_,
-        to,
-        mode=mode,
-        departure_time=departure_time
+    steps = None
+    route = recall_route()
+    if route and route['mode'] == mode and route['from'] == from_:
+        steps = route['steps']
+    elif mode == 'walking':
+        steps = route_store.get(quantize_lat_lon(from_), to)
+
+    call_sid = request.values.get('CallSid')
+    if steps is None and call_sid is None:
+        steps = find_steps(from_, mode, departure_time)
+    elif steps is None:
+        # look the route up in the background; if Google is slow the
+        # caller is put on hold rather than left in silence
+        future = directions_jobs.get(call_sid, (from_, mode))
+        if future is None:
+            future = directions_jobs.start(
+                call_sid, (from_, mode),
+                route_job, call_sid, from_, mode, digits, departure_time
+            )
+            # only for a new job, so a repeated request can't put off
+            # giving up on it
+            remember(job={
+                'from': from_, 'mode': mode, 'digits': digits,
+                'started': time.time()
+            }, route_error=None)
+        try:
+            steps = future.result(timeout=HOLD_AFTER)
+        except TimeoutError:
+            return HOLD_RESPONSE
+
+    remember(route={
+        'mode': mode, 'from': from_, 'digits': digits, 'steps': steps
+    })
+    return instructions_response(steps, from_, digits)
+
+
+def recall_route():
+    route = recall('route')
+    if route is None or 'steps' not in route:
+        # none, or one kept by an older version, before routes were paged
+        return None
+    return route
+
+
+def find_steps(from_, mode, departure_time):
+    """
+    The steps of Google's route, still unparsed; empty if it has no route
+    """
+    directions_result = get_directions(
+        from_, ADDRESSTO, mode, departure_time
     )
     if not directions_result:
-        return res.say('No routes could be found').hangup()
+        return []
+    return route_steps(directions_result[0])
+
 
-    directions_result = directions_result[0]
+def route_job(call_sid, from_, mode, digits, departure_time):
+    # the poll may land on another worker, which only sees the session
+    try:
+        steps = find_steps(from_, mode, departure_time)
+    except Exception as e:
+        call_sessions.update(call_sid, route_error={
+            'mode': mode, 'from': from_, 'error': repr(e)
+        })
+        raise
+    call_sessions.update(call_sid, route={
+        'mode': mode, 'from': from_, 'digits': digits, 'steps': steps
+    })
+    return steps
+
+
+@app.route('/location/route_ready', methods=['POST'])
+@twiml
+def route_ready():
+    job = recall('job')
+    if job is None:
+        return ERROR_RESPONSE
+    return route_ready_response(request.values['CallSid'], job)
+
+
+def route_ready_response(call_sid, job):
+    route = recall_route()
+    if route and route['mode'] == job['mode'] \
+            and route['from'] == job['from']:
+        return instructions_response(
+            route['steps'], job['from'], job['digits']
+        )
 
-    for leg in directions_result['legs']:
-        for step in leg['steps']:
-            if step['travel_mode'] == 'TRANSIT':
-                instruction = parse_transit_step(step)
-            else:
-                instruction = parse_instruction(step['html_instructions'])
+    error = recall('route_error')
+    if error and error['mode'] == job['mode'] \
+            and error['from'] == job['from']:
+        logging.warning('Directions job failed: %s', error['error'])
+        return ERROR_RESPONSE
+
+    future = directions_jobs.get(call_sid, (job['from'], job['mode']))
+    if future is not None and future.done():
+        try:
+            steps = future.result()
+        except Exception:
+            logging.exception('Directions job failed')
+            return ERROR_RESPONSE
+        return instructions_response(steps, job['from'], job['digits'])
+
+    # still running, here or in another worker
+    if time.time() - job['started'] > HOLD_TIMEOUT:
+        logging.warning('Gave up waiting on directions for %s', call_sid)
+        return ERROR_RESPONSE
+    return STILL_HOLDING_RESPONSE
+
+
+@app.route('/location/route_page', methods=['POST'])
+@twiml
+def route_page():
+    route = recall_route()
+    if route is None:
+        return ERROR_RESPONSE
+    return instructions_response(
+        route['steps'], route['from'], route['digits'],
+        page=int(request.args.get('page') or recall('page'))
+    )
 
-            res.say(instruction)
-            res.pause(length=1)
 
-    res.say("End of instructions")
+def instructions_response(steps, from_, digits, page=0):
+    """
+    One page of the route; only its steps are parsed. Without a call
+    session to keep the route in, the whole route is one page.
+    """
+    if not steps:
+        return NO_ROUTES_RESPONSE
 
-    action = params_and_url_for(
-        'possibly_repeat',
-        {
-            'latlon': from_,
-            'Digits': digits
-        }
-    )
+    if request.values.get('CallSid') is None:
+        page_steps, more = steps, False
+    else:
+        start = page * ROUTE_PAGE_STEPS
+        page_steps = steps[start:start + ROUTE_PAGE_STEPS]
+        more = start + ROUTE_PAGE_STEPS < len(steps)
+
+    res = Response()
+    for step in page_steps:
+        res.say(speak_step(step))
+        res.pause(length=1)
+
+    if more:
+        action = stateful_url_for('route_page', page=page + 1)
+        with res.gather(numDigits=1, action=action,
+                        timeout=ROUTE_PAGE_TIMEOUT) as gat:
+            gat.say(CONTINUE_PROMPT)
+        # carry on anyway if they don't press anything
+        res.redirect(action)
+        return res
+
+    res.say(END_OF_INSTRUCTIONS_PROMPT)
+
+    action = stateful_url_for('possibly_repeat', latlon=from_, Digits=digits)
     with res.gather(numDigits=1, action=action) as gat:
-        gat.say(
-            'Enter 1 to repeat instructions, or hang up.',
-        )
+        gat.say(REPEAT_PROMPT)
 
     return res
 
 
+# all parse_transit_step and parse_instruction need of a step
+STEP_FIELDS = ('travel_mode', 'html_instructions', 'transit_details',
+               'duration')
+
+
+def route_steps(directions_result):
+    return [
+        {key: step[key] for key in STEP_FIELDS if key in step}
+        for leg in directions_result['legs']
+        for step in leg['steps']
+    ]
+
+
+def speak_step(step):
+    """
+    The spoken form of a step; precomputed routes are already spoken
+    """
+    if isinstance(step, str):
+        return step
+    if step['travel_mode'] == 'TRANSIT':
+        return parse_transit_step(step)
+    return parse_instruction(step['html_instructions'])
+
+
+def route_instructions(directions_result):
+    return [
+        speak_step(step)
+        for step in route_steps(directions_result)
+    ]
+
+
+def quantize_lat_lon(latlon, precision=DIRECTIONS_PRECISION):
+    return ', '.join(
+        '{:.{}f}'.format(float(part), precision)
+        for part in latlon.split(',')
+    )
+
+
+def directions_key(from_, to, mode, departure_time):
+    from_ = quantize_lat_lon(from_)
+
+    if mode == 'transit':
+        timestamp = departure_time.timestamp()
+        bucket = int(timestamp // TRANSIT_BUCKET)
+        ttl = (bucket + 1) * TRANSIT_BUCKET - timestamp
+    else:
+        bucket = None
+        ttl = WALKING_TTL
+
+    return (from_, to, mode, bucket), ttl
+
+
+def get_directions(from_, to, mode, departure_time):
+    key, ttl = directions_key(from_, to, mode, departure_time)
+    # before the cache, which a finished prefetch has already filled, so
+    # the prefetch is counted and its future let go
+    future = prefetcher.take(key)
+    if future is not None:
+        # a caller is waiting on it now
+        google_scheduler.promote(key, LIVE)
+        try:
+            return future.result()
+        except Exception:
+            logging.exception('Prefetched directions failed, refetching')
+
+    directions_result = directions_cache.get(key)
+    if directions_result is not None:
+        logging.info('Directions cache hit for %s', key)
+        return directions_result
+
+    return fetch_directions(key, ttl, departure_time)
+
+
+def fetch_directions(key, ttl, departure_time, priority=LIVE):
+    return directions_flights.do(
+        key, request_directions, key, ttl, departure_time, priority
+    )
+
+
+def request_directions(key, ttl, departure_time, priority=LIVE):
+    from_, to, mode, _ = key
+
+    def fetch():
+        return google_scheduler.call(
+            priority,
+            gmaps.directions,
+            from_,
+            to,
+            mode=mode,
+            departure_time=departure_time,
+            key=key
+        )
+
+    def fallback():
+        stale.append(key)
+        return stale_directions.get(key[:3])
+
+    stale = []
+    if priority != LIVE:
+        directions_result = fetch()
+    else:
+        directions_result = google_calls.call(fetch, fallback=fallback)
+        if stale:
+            # don't cache a stale route as if it were fresh
+            return directions_result
+
+    if not directions_result:
+        ttl = min(ttl, NO_ROUTE_TTL)
+    elif mode == 'walking':
+        stale_directions.set(key[:3], directions_result)
+    return directions_cache.set(
+        key,
+        directions_result,
+        ttl=ttl,
+        size=len(json.dumps(directions_result))
+    )
+
+
+def prefetch_directions(latlon):
+    """
+    Start fetching both kinds of directions from `latlon` while the caller
+    is still listening to the menu
+    """
+    departure_time = datetime.now()
+    for mode in ['walking', 'transit']:
+        if mode == 'walking' and route_store.get(
+                quantize_lat_lon(latlon), ADDRESSTO) is not None:
+            continue
+
+        key, ttl = directions_key(latlon, ADDRESSTO, mode, departure_time)
+        if key not in directions_cache:
+            prefetcher.submit(
+                key, fetch_directions, key, ttl, departure_time, PREFETCH
+            )
+
+
 @app.errorhandler(500)
 @app.errorhandler(400)
 @twiml
 def error(exc=None):
-    return (
-        Response()
-        .say("I'm sorry, something seems to have gone wrong. Goodbye")
-        .hangup()
-    )
+    return ERROR_RESPONSE
 
 
 @app.route('/possibly_repeat', methods=['POST'])
@@ -352,11 +972,11 @@ def possibly_repeat():
 
     if digits == '1':
         return payphone_found_response(
-            request.args['Digits'],
-            request.args['latlon']
+            request.args.get('Digits') or recall('Digits'),
+            request.args.get('latlon') or recall('latlon')
         )
 
-    return Response().say('Okay, goodbye').hangup()
+    return GOODBYE_RESPONSE
 
 
 def parse_transit_step(step):
@@ -369,11 +989,6 @@ def parse_transit_step(step):
         arrival_stop=transit_details['arrival_stop']['name'],
         duration=step['duration']['text']
     )
-    text = re.sub(
-        r'\w?mins\w?',
-        'minutes',
-        text
-    )
     text = mend_short_place_names(text)
     logging.info('Transit instruction: %s', text)
     return text
@@ -382,16 +997,33 @@ def parse_transit_step(step):
 @app.route('/location', methods=['POST'])
 @twiml
 def location():
+    cabinet_ids = payphone_client.cabinet_ids() if STAGED_ID_ENTRY else None
+    if cabinet_ids is None:
+        # staged entry is off, or there's no local index to settle part of
+        # an id against
+        return LOCATION_RESPONSE
+    return staged_location_response(cabinet_ids.next_stage(''))
+
+
+def location_response(num_digits=ID_NUM_DIGITS, action=None):
     res = Response()
-    with res.gather(numDigits=ID_NUM_DIGITS,
-                    action=url_for('id_recieved')) as g:
-        g.say(
-            'Please enter the {} digit payphone identification number'
-            .format(humanize.apnumber(ID_NUM_DIGITS))
-        )
+    with res.gather(numDigits=num_digits,
+                    action=action or url_for('id_recieved')) as g:
+        g.say(LOCATION_PROMPT)
     return res
 
 
+def staged_location_response(num_digits):
+    response = STAGED_LOCATION_RESPONSES.get(num_digits)
+    if response is None:
+        response = STAGED_LOCATION_RESPONSES[num_digits] = Constant(
+            lambda: location_response(num_digits, params_and_url_for(
+                'id_digits', {'prefix': '', 'gathers': 1}
+            ))
+        )
+    return response
+
+
 @app.route('/request', methods=['POST'])
 def request_twiml():
     return location()
@@ -404,6 +1036,9 @@ def index():
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
+    if PRESYNTHESIZE:
+        threading.Thread(target=warm_prompts, daemon=True).start()
+
     app.debug = not ON_HEROKU
     port = int(os.environ['PORT']) if ON_HEROKU else 5555
     app.run(port=port, host='0.0.0.0')
@@ -0,0 +1,124 @@
+"""
+Per-call state, keyed by Twilio's CallSid, so later steps of the menu can
+pick up what earlier ones worked out instead of carrying it in callback
+URLs.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from cache import LRUCache
+
+# longer than any call should last
+SESSION_TTL = int(os.environ.get('CALL_SESSION_TTL', 60 * 60))
+
+
+class MemorySessionStore:
+    """
+    Sessions held in this process; fine for a single worker.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=10000):
+        self.ttl = ttl
+        self._cache = LRUCache(max_entries=max_entries, default_ttl=ttl)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<MemorySessionStore {} calls>'.format(len(self._cache))
+
+    def get(self, call_sid):
+        return dict(self._cache.get(call_sid) or {})
+
+    def update(self, call_sid, **fields):
+        with self._lock:
+            self._cache.set(call_sid, dict(self.get(call_sid), **fields))
+
+    def clear(self):
+        self._cache.clear()
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore:
+    """
+    Sessions in a SQLite file, shared by every worker on the machine.
+    """
+    PURGE_EVERY = 100
+
+    def __init__(self, path, ttl=SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute(
+                'create table if not exists sessions ('
+                'call_sid text primary key, '
+                'data text not null, '
+                'expires real not null)'
+            )
+
+    def __repr__(self):
+        return '<SQLiteSessionStore "{}">'.format(self.path)
+
+    def _connect(self):
+        if getattr(self._local, 'conn', None) is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            self._local.conn = conn
+        return self._local.conn
+
+    def _read(self, conn, call_sid):
+        row = conn.execute(
+            'select data from sessions where call_sid = ? and expires > ?',
+            (call_sid, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get(self, call_sid):
+        return self._read(self._connect(), call_sid)
+
+    def update(self, call_sid, **fields):
+        conn = self._connect()
+        conn.execute('begin immediate')
+        try:
+            data = dict(self._read(conn, call_sid), **fields)
+            conn.execute(
+                'insert or replace into sessions values (?, ?, ?)',
+                (call_sid, json.dumps(data), time.time() + self.ttl)
+            )
+
+            self._writes += 1
+            if self._writes % SQLiteSessionStore.PURGE_EVERY == 0:
+                conn.execute(
+                    'delete from sessions where expires <= ?', (time.time(),)
+                )
+        except Exception:
+            conn.execute('rollback')
+            raise
+        conn.execute('commit')
+
+    def clear(self):
+        self._connect().execute('delete from sessions')
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def session_store(spec=None):
+    """
+    Build the store described by `spec` (default $CALL_SESSIONS): 'memory',
+    or 'sqlite:<path>'
+    """
+    spec = spec or os.environ.get('CALL_SESSIONS', 'memory')
+    if spec == 'memory':
+        return MemorySessionStore()
+    if spec.startswith('sqlite:'):
+        return SQLiteSessionStore(spec[len('sqlite:'):])
+    raise ValueError('Unknown call session store "{}"'.format(spec))
@@ -1,9 +1,36 @@
 import os
+import json
 import server
 import unittest
 from unittest.mock import patch
 from server import checksum
+from cache import LRUCache
+from clients import PooledAdapter
+from lexicon import Lexicon
+from routes import RouteStore
+from sessions import SQLiteSessionStore
+from prefetch import Prefetcher
+from coalesce import SingleFlight
+from resilience import (
+    HEDGE_MIN_SAMPLES, CircuitBreaker, CircuitOpen, Resilient
+)
+from scheduler import BATCH, LIVE, PREFETCH, Scheduler, Shed, TokenBucket
+from lazy import Lazy
+from cabinets import CabinetIds
+from tts import AudioCache, prerendered_name, presynthesize
+from twiml import Response
+from payphones import (
+    ALL_PAYPHONES, FeatureService, PayPhones, PayPhoneIndex, Table,
+    iter_json_array
+)
+from benchmarks.fake_backends import FakeFeatureService, payphone
+from nearest import NearestPayPhones
+import sys
 import tempfile
+import threading
+import subprocess
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import logging
 from lxml.etree import fromstring, tostring
 from formencode.doctest_xml_compare import xml_compare
@@ -16,6 +43,19 @@ class MenuSystemTestCase(unittest.TestCase):
         self.db_fd, server.app.config['DATABASE'] = tempfile.mkstemp()
         server.app.config['TESTING'] = True
         self.app = server.app.test_client()
+        server.directions_cache.clear()
+        server.stale_directions.clear()
+        server.call_sessions.clear()
+        server.directions_jobs.clear()
+        # nothing speculative unless a test asks for it, and no holding
+        # on a mocked Google unless a test asks for that
+        for patcher in [
+            patch('server.prefetcher', Prefetcher(max_pending=0)),
+            patch('server.HOLD_AFTER', 5),
+            patch('server.google_calls', Resilient('google')),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     def tearDown(self):
         os.close(self.db_fd)
@@ -81,6 +121,29 @@ class TestLocation(MenuSystemTestCase):
             ).data
         )
 
+    @patch('payphones.PayPhones.by_cabinet_id', return_value=[{
+        'properties': dict(PAYPHONE_RESPONSE[0]['properties'],
+                           SSC_Name='Wilton & <Ashby>')
+    }])
+    def test_id_recieved_escapes_suburb(self, by_cabinet_id):
+        self.assertIn(
+            b'<Say language="en-AU">'
+            b'Payphone found in Wilton &amp; &lt;Ashby&gt;'
+            b'</Say>',
+            self.app.post(
+                '/location/id_recieved',
+                data={'Digits': '089458082'}
+            ).data
+        )
+
+    def test_constant_response_etag(self):
+        first = self.app.post('/location')
+        self.assertTrue(first.headers['ETag'])
+        self.assertEqual(
+            self.app.post('/request').headers['ETag'],
+            first.headers['ETag']
+        )
+
     @patch('payphones.PayPhones.by_cabinet_id',
            return_value=[])
     def test_id_recieved_phone_not_found(self, by_cabinet_id):
@@ -127,6 +190,37 @@ class TestLocation(MenuSystemTestCase):
             ).data
         )
 
+    @patch('server.gmaps.directions', return_value=[])
+    def test_directions_cached(self, directions):
+        for latlon in ['123.00001, 321', '123, 321.00002']:
+            self.app.post(
+                '/location/payphone_found',
+                query_string={'latlon': latlon},
+                data={'Digits': '1'}
+            )
+
+        directions.assert_called_once()
+        self.assertEqual(directions.call_args[0][0], '123.0000, 321.0000')
+        self.assertEqual(server.directions_cache.hits, 1)
+
+    @patch('server.gmaps.directions')
+    def test_precomputed_walking_route(self, directions):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        store = RouteStore(path)
+        store.put('123.0000, 321.0000', server.ADDRESSTO, ['Walk home .'])
+
+        with patch('server.route_store', store):
+            data = self.app.post(
+                '/location/payphone_found',
+                query_string={'latlon': '123, 321'},
+                data={'Digits': '1'}
+            ).data
+
+        self.assertFalse(directions.called)
+        self.assertIn(b'<Say language="en-AU">Walk home .</Say>', data)
+
     def test_invalid_transportation_mode(self):
         self.assertXMLEqual(
             b'<?xml version="1.0" encoding="UTF-8"?>'
@@ -150,7 +244,7 @@ class TestLocation(MenuSystemTestCase):
                 '<div style="font-size:0.9em">Destination '
                 'will be on the left</div>'
             ),
-            'Turn right to stay on Kent St . Destination will be on the left .'
+            'Turn right to stay on Kent Street . Destination will be on the left .'
         )
 
         self.assertEqual(
@@ -158,6 +252,19 @@ class TestLocation(MenuSystemTestCase):
             'Move forward Station .'
         )
 
+    def test_parse_instruction_corpus(self):
+        from server import parse_instruction
+
+        corpus = os.path.join(
+            os.path.dirname(__file__), 'benchmarks', 'instructions.json'
+        )
+        with open(corpus) as fh:
+            corpus = json.load(fh)
+
+        for html, expected in corpus:
+            with self.subTest(html=html):
+                self.assertEqual(parse_instruction(html), expected)
+
     def test_easter_egg(self):
         self.assertXMLEqual(
             b'<?xml version="1.0" encoding="UTF-8"?>'
@@ -172,6 +279,1110 @@ class TestLocation(MenuSystemTestCase):
         )
 
 
+class TestCallSessions(MenuSystemTestCase):
+    PAYPHONES = [
+        {'properties': {'SSC_Name': 'Wilton', 'Latitude': 1, 'Longitude': 2}},
+        {'properties': {'SSC_Name': 'Ashby', 'Latitude': 3, 'Longitude': 4}},
+    ]
+
+    def post(self, url, **data):
+        return self.app.post(url, data=dict(data, CallSid='CA123')).data
+
+    @patch('server.gmaps.directions')
+    def test_state_kept_server_side(self, directions):
+        directions.return_value = [{'legs': [{'steps': [
+            {'html_instructions': 'Walk home', 'travel_mode': 'WALKING'}
+        ]}]}]
+
+        with patch('payphones.PayPhones.by_cabinet_id',
+                   return_value=self.PAYPHONES):
+            menu = self.post('/location/id_recieved', Digits='089458082')
+        self.assertIn(b'action="/select_payphone_suburb"', menu)
+
+        menu = self.post('/select_payphone_suburb', Digits='2')
+        self.assertIn(b'action="/location/payphone_found"', menu)
+
+        route = self.post('/location/payphone_found', Digits='1')
+        self.assertIn(b'Walk home .', route)
+        self.assertIn(b'action="/possibly_repeat"', route)
+        self.assertEqual(directions.call_args[0][0], '3.0000, 4.0000')
+
+        server.directions_cache.clear()
+        self.assertEqual(self.post('/possibly_repeat', Digits='1'), route)
+        directions.assert_called_once()
+
+
+class TestHold(MenuSystemTestCase):
+    def post(self, url, **data):
+        return self.app.post(url, data=dict(data, CallSid='CA123')).data
+
+    @patch('server.HOLD_AFTER', 0)
+    @patch('server.gmaps.directions')
+    def test_hold_then_redirect(self, directions):
+        release = threading.Event()
+
+        def slow_directions(*args, **kwargs):
+            release.wait(5)
+            return [{'legs': [{'steps': [
+                {'html_instructions': 'Walk home', 'travel_mode': 'WALKING'}
+            ]}]}]
+        directions.side_effect = slow_directions
+
+        hold = self.post(
+            '/location/payphone_found?latlon=1,2', Digits='1'
+        ).decode()
+        self.assertEqual(hold, server.HOLD_RESPONSE.toxml())
+        self.assertIn(
+            '<Redirect method="POST">/location/route_ready</Redirect>', hold
+        )
+        self.assertEqual(
+            self.post('/location/route_ready').decode(),
+            server.STILL_HOLDING_RESPONSE.toxml()
+        )
+
+        # pressing again joins the same job, without putting off its timeout
+        started = server.call_sessions.get('CA123')['job']['started']
+        self.post('/location/payphone_found?latlon=1,2', Digits='1')
+        self.assertEqual(
+            server.call_sessions.get('CA123')['job']['started'], started
+        )
+
+        release.set()
+        server.directions_jobs.get('CA123', ('1,2', 'walking')).result(5)
+        route = self.post('/location/route_ready')
+        self.assertIn(b'Walk home .', route)
+        self.assertIn(b'action="/possibly_repeat"', route)
+
+        # a second press while the route is known doesn't hold
+        self.assertEqual(
+            self.post('/location/payphone_found?latlon=1,2', Digits='1'),
+            route
+        )
+        directions.assert_called_once()
+
+    @patch('server.HOLD_AFTER', 0)
+    def test_hold_gives_up(self):
+        with patch('server.directions_jobs.get', return_value=None):
+            with server.app.test_request_context(data={'CallSid': 'CA1'}):
+                self.assertIs(
+                    server.route_ready_response('CA1', {
+                        'from': '1,2', 'mode': 'walking', 'digits': '1',
+                        'started': 0
+                    }),
+                    server.ERROR_RESPONSE
+                )
+
+    @patch('server.HOLD_AFTER', 0)
+    @patch('server.gmaps.directions', side_effect=Exception('no route'))
+    def test_failed_job_on_another_worker(self, directions):
+        self.post('/location/payphone_found?latlon=1,2', Digits='1')
+        future = server.directions_jobs.get('CA123', ('1,2', 'walking'))
+        self.assertRaises(Exception, future.result, 5)
+
+        # the poll lands where the job isn't running, and only has the
+        # session to go on
+        with patch('server.directions_jobs.get', return_value=None):
+            self.assertEqual(
+                self.post('/location/route_ready').decode(),
+                server.ERROR_RESPONSE.toxml()
+            )
+
+
+class TestRoutePages(MenuSystemTestCase):
+    def post(self, url, **data):
+        return self.app.post(url, data=dict(data, CallSid='CA123')).data
+
+    @patch('server.ROUTE_PAGE_STEPS', 2)
+    @patch('server.parse_instruction', side_effect=lambda html: html)
+    @patch('server.gmaps.directions')
+    def test_long_route_paged(self, directions, parse_instruction):
+        directions.return_value = [{'legs': [{'steps': [
+            {'html_instructions': 'Step {}'.format(idx),
+             'travel_mode': 'WALKING'}
+            for idx in range(5)
+        ]}]}]
+
+        first = self.post('/location/payphone_found?latlon=1,2', Digits='1')
+        self.assertIn(b'Step 1', first)
+        self.assertNotIn(b'Step 2', first)
+        self.assertIn(b'action="/location/route_page"', first)
+        self.assertIn(b'<Redirect method="POST">/location/route_page', first)
+        self.assertIn(b'timeout="1"', first)
+        # only the first page has been parsed
+        self.assertEqual(parse_instruction.call_count, 2)
+
+        second = self.post('/location/route_page')
+        self.assertIn(b'Step 2', second)
+        self.assertIn(b'Step 3', second)
+        self.assertNotIn(b'End of instructions', second)
+
+        last = self.post('/location/route_page')
+        self.assertIn(b'Step 4', last)
+        self.assertIn(b'End of instructions', last)
+        self.assertIn(b'action="/possibly_repeat"', last)
+        directions.assert_called_once()
+
+    @patch('server.gmaps.directions')
+    def test_session_from_before_paging(self, directions):
+        directions.return_value = [{'legs': [{'steps': [
+            {'html_instructions': 'Walk home', 'travel_mode': 'WALKING'}
+        ]}]}]
+        server.call_sessions.update('CA123', route={
+            'mode': 'walking', 'from': '1,2', 'instructions': ['Old']
+        })
+        route = self.post('/location/payphone_found?latlon=1,2', Digits='1')
+        self.assertIn(b'Walk home .', route)
+
+    def test_route_page_without_route(self):
+        self.assertEqual(
+            self.post('/location/route_page', page='1').decode(),
+            server.ERROR_RESPONSE.toxml()
+        )
+
+
+class TestPreload(MenuSystemTestCase):
+    def test_preload_then_fork(self):
+        with patch('payphones.PayPhones.nearest') as nearest, \
+                patch('payphones.FeatureService.warm') as warm:
+            server.preload()
+        # nothing remote before the fork
+        warm.assert_not_called()
+        nearest.assert_called_once()
+        self.assertIsNotNone(server.GOODBYE_RESPONSE._xml)
+        self.assertIsNotNone(server.LOCATION_RESPONSE._etag)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = RouteStore(os.path.join(directory.name, 'routes.db'))
+        with patch('server.route_store', store), \
+                patch('payphones.FeatureService.warm') as warm, \
+                patch('server.PRESYNTHESIZE', True), \
+                patch('server.warm_prompts') as warm_prompts:
+            store.put('1, 2', 'home', ['Walk'])
+            server.after_fork()
+            self.assertIsNone(store._local.conn)
+            for _ in range(500):
+                if warm.called and warm_prompts.called:
+                    break
+                threading.Event().wait(0.01)
+            warm.assert_called_once_with([ALL_PAYPHONES])
+            warm_prompts.assert_called_once()
+            self.assertEqual(store.get('1, 2', 'home'), ['Walk'])
+
+    def test_connections_closed_after_request(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = RouteStore(os.path.join(directory.name, 'routes.db'))
+        store.put('1, 2', 'home', ['Walk'])
+        with patch('server.route_store', store):
+            self.app.post('/location/route_ready')
+        self.assertIsNone(store._local.conn)
+
+
+class TestStartup(unittest.TestCase):
+    def test_heavy_imports_deferred(self):
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, server; '
+            'print(sorted({"googlemaps", "lxml", "numpy"} & set(sys.modules)))'
+        ], stderr=subprocess.DEVNULL, universal_newlines=True)
+        self.assertEqual(loaded.strip(), '[]')
+
+    def test_lazy(self):
+        built = []
+
+        def factory():
+            built.append(1)
+            return logging.getLogger('lazy-test')
+
+        logger = Lazy(factory)
+        self.assertEqual(built, [])
+        with patch.object(logger, 'info') as info:
+            logger.info('hello')
+        info.assert_called_once_with('hello')
+        self.assertEqual(logger.name, 'lazy-test')
+        self.assertNotIn('info', vars(logging.getLogger('lazy-test')))
+        self.assertEqual(built, [1])
+
+
+class TestPrefetch(MenuSystemTestCase):
+    @patch('server.gmaps.directions', return_value=[])
+    def test_directions_prefetched(self, directions):
+        prefetcher = Prefetcher()
+        with patch('server.prefetcher', prefetcher), \
+                patch('payphones.PayPhones.by_cabinet_id',
+                      return_value=PAYPHONE_RESPONSE):
+            self.app.post(
+                '/location/id_recieved', data={'Digits': '089458082'}
+            )
+            self.assertEqual(prefetcher.submitted, 2)
+            self.app.post(
+                '/location/payphone_found',
+                query_string={'latlon': '123, 321'},
+                data={'Digits': '2'}
+            )
+
+        self.assertEqual(
+            sorted(call[1]['mode'] for call in directions.call_args_list),
+            ['transit', 'walking']
+        )
+        self.assertEqual(prefetcher.hidden + prefetcher.waited, 1)
+
+    @patch('server.gmaps.directions', return_value=[])
+    def test_finished_prefetch_counted(self, directions):
+        prefetcher = Prefetcher()
+        departure_time = server.datetime.now()
+        key, ttl = server.directions_key(
+            '1,2', server.ADDRESSTO, 'walking', departure_time
+        )
+        prefetcher.submit(
+            key, server.fetch_directions, key, ttl, departure_time
+        )
+        # finished, and in the cache, before the caller asks for it
+        while prefetcher.pending:
+            threading.Event().wait(0.01)
+        self.assertIn(key, server.directions_cache)
+
+        with patch('server.prefetcher', prefetcher):
+            self.assertEqual(
+                server.get_directions(
+                    '1,2', server.ADDRESSTO, 'walking', departure_time
+                ),
+                []
+            )
+        self.assertEqual(prefetcher.stats['hidden'], 1)
+        self.assertIsNone(prefetcher.take(key))
+        directions.assert_called_once()
+
+    def test_shed_over_cap(self):
+        prefetcher = Prefetcher(max_pending=1)
+        started = threading.Event()
+        prefetcher.submit('a', started.wait)
+        self.assertFalse(prefetcher.submit('b', started.wait))
+        self.assertEqual(prefetcher.stats['shed'], 1)
+        started.set()
+
+
+class TestSingleFlight(unittest.TestCase):
+    def concurrently(self, flight, func, callers):
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(flight.do('key', func))
+            )
+            for _ in range(callers)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_share_one(self):
+        flight = SingleFlight('test')
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            release.wait(5)
+            return len(calls)
+
+        threads, results = self.concurrently(flight, func, 4)
+        while flight.stats['calls'] < 4:
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [1] * 4)
+        self.assertEqual(
+            flight.stats,
+            {'calls': 4, 'executed': 1, 'saved': 3, 'in_flight': 0}
+        )
+        # nothing in flight, so the next call goes to the backend again
+        self.assertEqual(flight.do('key', func), 2)
+
+    def test_exception_shared(self):
+        flight = SingleFlight('test')
+        future, leader = flight.join('key')
+        waiter, waiter_leads = flight.join('key')
+        self.assertTrue(leader)
+        self.assertFalse(waiter_leads)
+
+        flight.finish('key', exception=ValueError('backend down'))
+        with self.assertRaises(ValueError):
+            waiter.result()
+
+
+class TestScheduler(unittest.TestCase):
+    def blocked(self, **kwargs):
+        """
+        A scheduler with one worker, busy until the returned event is set
+        """
+        scheduler = Scheduler('test', rate=1000, daily_budget=100,
+                              workers=1, **kwargs)
+        release, running = threading.Event(), threading.Event()
+
+        def block():
+            running.set()
+            release.wait(5)
+        scheduler.submit(LIVE, block)
+        running.wait(5)
+        return scheduler, release
+
+    def test_priority_order(self):
+        scheduler, release = self.blocked()
+        order = []
+        futures = [
+            scheduler.submit(priority, order.append, name)
+            for priority, name in [
+                (BATCH, 'batch'), (PREFETCH, 'prefetch'), (LIVE, 'live')
+            ]
+        ]
+        release.set()
+        for future in futures:
+            future.result(5)
+        self.assertEqual(order, ['live', 'prefetch', 'batch'])
+
+    def test_low_priority_shed_first(self):
+        scheduler, release = self.blocked(max_queued=2)
+        batch = scheduler.submit(BATCH, str, 'batch')
+        prefetch = scheduler.submit(PREFETCH, str, 'prefetch')
+        live = scheduler.submit(LIVE, str, 'live')
+        # full of more urgent work, so this one goes straight away
+        late = scheduler.submit(BATCH, str, 'late')
+        release.set()
+
+        self.assertEqual(live.result(5), 'live')
+        self.assertEqual(prefetch.result(5), 'prefetch')
+        for future in [batch, late]:
+            with self.assertRaises(Shed):
+                future.result(5)
+        self.assertEqual(scheduler.stats['shed']['batch'], 2)
+
+    def test_budget_reserved_for_live(self):
+        scheduler = Scheduler('test', rate=1000, daily_budget=4)
+        # batch leaves a quarter of the budget for everything else
+        batch = [scheduler.submit(BATCH, int) for _ in range(4)]
+        self.assertEqual(
+            [future.exception(5) is None for future in batch],
+            [True, True, True, False]
+        )
+        self.assertEqual(scheduler.call(LIVE, int), 0)
+        self.assertEqual(scheduler.stats['budget_remaining'], 0)
+        # spent, but live callers still get through; nothing else does
+        self.assertEqual(scheduler.call(LIVE, int), 0)
+        with self.assertRaises(Shed):
+            scheduler.call(PREFETCH, int)
+        self.assertEqual(scheduler.stats['shed']['live'], 0)
+        self.assertEqual(scheduler.budget.used, 5)
+
+    def test_promote(self):
+        scheduler, release = self.blocked()
+        order = []
+        scheduler.submit(PREFETCH, order.append, 'prefetch')
+        scheduler.submit(BATCH, order.append, 'batch', key='route')
+        self.assertTrue(scheduler.promote('route', LIVE))
+        self.assertFalse(scheduler.promote('other', LIVE))
+        release.set()
+        scheduler.call(BATCH, order.append, 'last')
+        self.assertEqual(order, ['batch', 'prefetch', 'last'])
+
+    def test_token_bucket(self):
+        now = [0]
+        bucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0])
+        self.assertEqual([bucket.try_take(), bucket.try_take()], [0, 0])
+        self.assertEqual(bucket.try_take(), 0.5)
+        now[0] = 0.5
+        self.assertEqual(bucket.try_take(), 0)
+
+
+class TestResilience(unittest.TestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(path)
+        self.addCleanup(lambda: os.path.exists(path) and os.unlink(path))
+        self.index = PayPhoneIndex(path, max_age=0)
+
+    def payphones(self, latencies, budget):
+        """
+        PayPhones on a fake FeatureService taking each of `latencies`
+        seconds to answer in turn
+        """
+        latencies = iter(latencies)
+        fake = FakeFeatureService(count=1, latency=lambda: next(latencies))
+        fake.__enter__()
+        self.addCleanup(fake.__exit__)
+
+        payphones = PayPhones(self.index)
+        payphones.fs = FeatureService(fake.base)
+        payphones.fs.sess = requests.Session()
+        payphones.remote = Resilient('featureservice', budget=budget)
+        return payphones
+
+    def test_hedge_beats_slow_request(self):
+        payphones = self.payphones([1, 0], budget=0.5)
+        self.assertEqual(
+            payphones.by_cabinet_id('00000000'),
+            [payphone(0)]
+        )
+        stats = payphones.remote.stats
+        self.assertEqual((stats['hedged'], stats['hedge_won']), (1, 1))
+        self.assertEqual(stats['fallbacks'], 0)
+
+    def test_stale_index_over_budget(self):
+        self.index.build([payphone(7)])
+        payphones = self.payphones([1, 1], budget=0.2)
+        self.assertEqual(
+            payphones.by_cabinet_id('00000007'),
+            [payphone(7)]
+        )
+        stats = payphones.remote.stats
+        self.assertEqual((stats['over_budget'], stats['fallbacks']), (1, 1))
+
+    def test_over_budget_without_fallback(self):
+        payphones = self.payphones([1, 1], budget=0.2)
+        with self.assertRaises(TimeoutError):
+            payphones.by_cabinet_id('00000000')
+
+    def test_circuit_breaker(self):
+        now = [0]
+        remote = Resilient('test', budget=1, breaker=CircuitBreaker(
+            'test', failures=2, reset=30, clock=lambda: now[0]
+        ))
+
+        def down():
+            raise requests.ConnectionError()
+        for _ in range(2):
+            with self.assertRaises(requests.ConnectionError):
+                remote.call(down)
+        self.assertEqual(remote.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpen):
+            remote.call(int)
+        self.assertEqual(remote.call(int, fallback=lambda: 'stale'), 'stale')
+
+        now[0] = 30
+        self.assertEqual(remote.call(int), 0)
+        self.assertEqual(remote.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(remote.stats['short_circuited'], 2)
+
+    @patch('server.gmaps.directions')
+    def test_stale_directions(self, directions):
+        route = [{'legs': []}]
+        release = threading.Event()
+        self.addCleanup(release.set)
+        directions.return_value = route
+        now = server.datetime.now()
+        walking, ttl = server.directions_key('1,2', 'home', 'walking', now)
+        transit, _ = server.directions_key('1,2', 'home', 'transit', now)
+        with patch('server.google_calls', Resilient('google', budget=0.2)):
+            for key in [walking, transit]:
+                self.assertEqual(
+                    server.request_directions(key, ttl, None), route
+                )
+
+            directions.side_effect = lambda *a, **kw: release.wait(5)
+            server.directions_cache.clear()
+            self.assertEqual(
+                server.request_directions(walking, ttl, None), route
+            )
+            # an old transit route's departures have been and gone
+            later = transit[:3] + (transit[3] + 1,)
+            with self.assertRaises(TimeoutError):
+                server.request_directions(later, ttl, None)
+            self.assertEqual(server.google_calls.stats['fallbacks'], 1)
+        # not mistaken for a fresh answer
+        self.assertNotIn(walking, server.directions_cache)
+
+    @patch('server.gmaps.directions', return_value=[])
+    def test_no_route_not_kept(self, directions):
+        now = server.datetime.now()
+        walking, ttl = server.directions_key('1,2', 'home', 'walking', now)
+        with patch.object(server.directions_cache, 'set') as cache_set:
+            server.request_directions(walking, ttl, None)
+        self.assertEqual(cache_set.call_args[1]['ttl'], server.NO_ROUTE_TTL)
+        self.assertIsNone(server.stale_directions.get(walking[:3]))
+
+    def test_no_hedge_behind_backlog(self):
+        backlog = [1]
+        remote = Resilient('test', budget=0.5, hedge_if=lambda: not backlog)
+
+        def slow():
+            threading.Event().wait(0.3)
+            return 'route'
+        self.assertEqual(remote.call(slow), 'route')
+        self.assertEqual(
+            (remote.stats['hedged'], remote.stats['hedge_skipped']), (0, 1)
+        )
+        backlog.clear()
+        self.assertEqual(remote.call(slow), 'route')
+        self.assertEqual(remote.stats['hedged'], 1)
+
+    def test_no_hedge_past_budget(self):
+        remote = Resilient('test', budget=0.2)
+        # most calls take longer than the budget, so a hedge couldn't win
+        remote._latencies.extend([0.5] * HEDGE_MIN_SAMPLES)
+
+        def slow():
+            threading.Event().wait(0.3)
+        with self.assertRaises(TimeoutError):
+            remote.call(slow)
+        self.assertEqual(
+            (remote.stats['hedged'], remote.stats['hedge_skipped']), (0, 1)
+        )
+
+
+class TestSQLiteSessionStore(unittest.TestCase):
+    def test_update(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'sessions.db')
+        store = SQLiteSessionStore(path)
+
+        store.update('CA1', latlon='1, 2')
+        store.update('CA1', Digits='1')
+        self.assertEqual(
+            SQLiteSessionStore(path).get('CA1'),
+            {'latlon': '1, 2', 'Digits': '1'}
+        )
+        self.assertEqual(store.get('CA2'), {})
+
+        store.ttl = -1
+        store.update('CA1', Digits='2')
+        self.assertEqual(store.get('CA1'), {})
+
+
+@patch('server.checksum', return_value='signature')
+class TestSpeech(MenuSystemTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.audio_cache = AudioCache(directory.name)
+        patcher = patch('server.audio_cache', self.audio_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_speech(self, **headers):
+        # buffered, so the response is closed once read, as a real
+        # server closes it
+        return self.app.get(
+            '/speech',
+            query_string={'text': 'Hello'},
+            headers=dict(headers, **{'X-Twilio-Signature': 'signature'}),
+            buffered=True
+        )
+
+    @patch('tts.watson.get')
+    def test_write_through_then_hit(self, get, checksum):
+        get.return_value.ok = True
+        get.return_value.iter_content.return_value = [b'RIFF', b'data']
+
+        cold = self.get_speech()
+        self.assertEqual(cold.data, b'RIFFdata')
+        self.assertEqual(self.audio_cache.stats['entries'], 1)
+
+        hot = self.get_speech()
+        self.assertEqual(hot.data, b'RIFFdata')
+        self.assertEqual(hot.headers['ETag'], cold.headers['ETag'])
+        self.assertIn('max-age', hot.headers['Cache-Control'])
+        get.assert_called_once()
+
+        revalidated = self.get_speech(**{'If-None-Match': hot.headers['ETag']})
+        self.assertEqual(revalidated.status_code, 304)
+
+    @patch('server.speech_flights', SingleFlight('speech'))
+    @patch('tts.watson.get')
+    def test_concurrent_synthesis_coalesced(self, get, checksum):
+        release = threading.Event()
+
+        def synthesize(*args, **kwargs):
+            release.wait(5)
+            return get.return_value
+        get.side_effect = synthesize
+        get.return_value.ok = True
+        get.return_value.iter_content.return_value = [b'RIFF', b'data']
+
+        responses = []
+        threads = [
+            threading.Thread(
+                target=lambda: responses.append(self.get_speech().data)
+            )
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        while server.speech_flights.stats['calls'] < 3:
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(responses, [b'RIFFdata'] * 3)
+        get.assert_called_once()
+        self.assertEqual(server.speech_flights.stats['saved'], 2)
+
+    @patch('server.speech_flights', SingleFlight('speech'))
+    @patch('tts.watson.get')
+    def test_unread_stream_finishes_flight(self, get, checksum):
+        get.return_value.ok = True
+        get.return_value.iter_content.return_value = [b'RIFF', b'data']
+
+        # Twilio hung up before reading any of it
+        self.app.get(
+            '/speech', query_string={'text': 'Hello'}, buffered=False,
+            headers={'X-Twilio-Signature': 'signature'}
+        ).close()
+        self.assertEqual(server.speech_flights.stats['in_flight'], 0)
+
+    def test_eviction(self, checksum):
+        self.audio_cache.max_bytes = 6
+        for text in ['one', 'two', 'three']:
+            key = self.audio_cache.key(text, 'voice', 'audio/wav')
+            list(self.audio_cache.write_through(key, [b'1234']))
+
+        self.assertEqual(self.audio_cache.stats['entries'], 1)
+        self.assertEqual(
+            os.listdir(self.audio_cache.directory),
+            [self.audio_cache.key('three', 'voice', 'audio/wav')]
+        )
+
+    def test_eviction_across_workers(self, checksum):
+        self.audio_cache.max_bytes = 6
+        other = AudioCache(self.audio_cache.directory, max_bytes=6)
+        one = self.audio_cache.key('one', 'voice', 'audio/wav')
+        two = other.key('two', 'voice', 'audio/wav')
+        list(self.audio_cache.write_through(one, [b'1234']))
+        list(other.write_through(two, [b'1234']))
+
+        self.assertEqual(os.listdir(self.audio_cache.directory), [two])
+        self.assertEqual(other.stats['size'], 4)
+
+
+class TestWatsonSay(MenuSystemTestCase):
+    def test_prerendered_prompt(self):
+        from twiml import WatsonSay
+
+        name = prerendered_name(server.GOODBYE_PROMPT)
+        with server.app.test_request_context(), \
+                patch('server.prerendered_prompts', {name}):
+            self.assertEqual(
+                WatsonSay(None, server.GOODBYE_PROMPT).url,
+                '/static/speech/' + name
+            )
+            self.assertEqual(
+                WatsonSay(None, 'Turn left').url,
+                '/speech?text=Turn+left'
+            )
+
+    @patch('tts.synthesize')
+    def test_presynthesize_survives_failures(self, synthesize):
+        def fake(text, stream):
+            if text == 'Broken':
+                raise requests.ConnectionError()
+            return unittest.mock.Mock(content=b'RIFF')
+        synthesize.side_effect = fake
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.assertEqual(
+            presynthesize(['Hello', 'Broken'], directory.name),
+            {prerendered_name('Hello')}
+        )
+
+
+class TestSerializers(unittest.TestCase):
+    def build(self, serializer):
+        res = Response(serializer)
+        res.say('Take the 98 from stop "Curtin Uni", towards <Perth> & back')
+        res.say('')
+        res.pause(length=1)
+        res.say('Line one\r\nline two', language='en-US')
+        with res.gather(numDigits=1, action='/repeat?a=1&b="2"\t') as g:
+            g.say('Enter 1 to repeat instructions, or hang up.')
+        res.gather(numDigits=9, action='/empty')
+        res.play('/static/a%20b.mp3', loop='2')
+        return res.hangup()
+
+    def test_identical_output(self):
+        self.assertEqual(
+            self.build('string').toxml(),
+            self.build('lxml').toxml()
+        )
+
+    def test_globals_copied_on_write(self):
+        american = Response().set_global('language', 'en-US')
+        american.say('Howdy')
+        australian = Response().say("G'day")
+
+        self.assertIn('language="en-US"', american.toxml())
+        self.assertIn('language="en-AU"', australian.toxml())
+        self.assertIs(australian.globals, Response.GLOBALS)
+
+    def test_empty_response(self):
+        self.assertEqual(
+            Response('string').toxml(),
+            Response('lxml').toxml()
+        )
+
+
+class TestExport(unittest.TestCase):
+    def test_iter_json_array(self):
+        document = json.dumps({
+            'type': 'FeatureCollection',
+            'features': [{'name': 'Café ]'}, {'id': 2}, []]
+        }).encode()
+        # split everywhere, including inside multi-byte characters
+        chunks = [document[i:i + 1] for i in range(len(document))]
+        self.assertEqual(
+            list(iter_json_array(chunks, 'features')),
+            [{'name': 'Café ]'}, {'id': 2}, []]
+        )
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"features": [{"id": 1}'], 'features'))
+
+    def fake(self, count):
+        fake = FakeFeatureService(count=count)
+        fake.__enter__()
+        self.addCleanup(fake.__exit__)
+        fs = FeatureService(fake.base)
+        fs.sess = requests.Session()
+        return fake, fs
+
+    def test_table_iter_features(self):
+        fake, fs = self.fake(count=2500)
+        features = Table(fs, '/payphones').iter_features(
+            page_length=1000, workers=3
+        )
+        self.assertEqual(
+            [f['properties']['CABINET_ID'] for f in features],
+            ['{:08d}'.format(idx) for idx in range(2500)]
+        )
+        # the count, then exactly the three pages it called for
+        self.assertEqual(len(fake.requests), 4)
+
+    def test_metadata_cached(self):
+        fake, fs = self.fake(count=10)
+        fs.warm(['/payphones'])
+        warmed = len(fake.requests)
+        self.assertEqual(warmed, 3)
+
+        table = Table(fs, '/payphones')
+        self.assertEqual(len(table), 10)
+        self.assertEqual(table.metadata['CABINET_ID'], {'type': 'String'})
+        self.assertEqual(table.metadata['CABINET_ID'], {'type': 'String'})
+        self.assertIn(
+            '/telstrappol/NamedTables/TLS_All_Payphones', fs.table_names
+        )
+        self.assertEqual(len(fake.requests), warmed)
+        self.assertEqual(fs.metadata_cache.stats['entries'], 3)
+
+        fake.count = 20
+        fs.invalidate('/payphones')
+        self.assertEqual(len(table), 20)
+        self.assertEqual(len(fake.requests), warmed + 1)
+
+    def test_metadata_expires(self):
+        fake, fs = self.fake(count=10)
+        fs.metadata_cache.default_ttl = -1
+        len(Table(fs, '/payphones'))
+        len(Table(fs, '/payphones'))
+        self.assertEqual(len(fake.requests), 2)
+
+    def test_sql_iter_features_stops_at_short_page(self):
+        fake, fs = self.fake(count=2000)
+        features = list(fs.iter_features(
+            'select * from "payphones"', page_length=1000, workers=1
+        ))
+        self.assertEqual(len(features), 2000)
+        # the third page was fetched to find the end
+        self.assertEqual(len(fake.requests), 3)
+
+
+CABINETS = [
+    {'properties': {
+        'CABINET_ID': cabinet_id, 'SSC_Name': suburb,
+        'Latitude': -32, 'Longitude': 115
+    }}
+    for cabinet_id, suburb in [
+        ('08945808-2', 'Wilton'), ('08945809-1', 'Bentley'),
+        ('07123456-7', 'Perth'), ('07123456-8', 'Perth'),
+    ]
+]
+
+
+class TestCabinetIds(unittest.TestCase):
+    def test_prefixes(self):
+        cabinet_ids = CabinetIds(CABINETS)
+        self.assertEqual(cabinet_ids.count('0894580'), 2)
+        self.assertEqual(
+            cabinet_ids.matches('08945808')[0]['properties']['SSC_Name'],
+            'Wilton'
+        )
+        self.assertEqual(cabinet_ids.count('1'), 0)
+        # ids sharing 7 and 8 digits with their neighbours
+        self.assertEqual(cabinet_ids.needed, [9, 9, 8, 8])
+        self.assertEqual(cabinet_ids.average_needed, 8.5)
+
+    def test_next_stage(self):
+        cabinet_ids = CabinetIds(CABINETS)
+        self.assertEqual(cabinet_ids.next_stage(''), 8)
+        self.assertEqual(cabinet_ids.next_stage('0894'), 4)
+        self.assertEqual(cabinet_ids.next_stage('07123456'), 1)
+        # nothing to settle; gather the rest
+        self.assertEqual(cabinet_ids.next_stage('5'), 8)
+
+
+class TestStagedLocation(MenuSystemTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        index = PayPhoneIndex(os.path.join(directory.name, 'payphones.db'))
+        index.build(CABINETS)
+        for patcher in [
+            patch('server.payphone_client', PayPhones(index)),
+            patch('server.STAGED_ID_ENTRY', True),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, url, **data):
+        return self.app.post(url, data=dict(data, CallSid='CA123')).data
+
+    @patch('server.STAGED_ID_ENTRY', False)
+    def test_off_by_default(self):
+        self.assertEqual(
+            self.post('/location').decode(),
+            server.LOCATION_RESPONSE.toxml()
+        )
+
+    def test_settled_early_and_confirmed(self):
+        stats = server.digit_stats.stats
+        self.assertIn(
+            b'<Gather action="/location/id_digits?prefix=&amp;gathers=1" '
+            b'numDigits="8">',
+            self.post('/location')
+        )
+
+        confirm = self.post(
+            '/location/id_digits?prefix=&gathers=1', Digits='08945808'
+        )
+        self.assertIn(b'Payphone found in Wilton', confirm)
+        self.assertIn(
+            b'<Gather action="/location/id_digits" numDigits="1" '
+            b'actionOnEmptyResult="true" finishOnKey="#">',
+            confirm
+        )
+
+        self.assertIn(
+            b'action="/location/payphone_found"',
+            self.post('/location/id_digits', Digits='')
+        )
+        self.assertEqual(
+            server.digit_stats.calls, stats['calls'] + 1
+        )
+
+    def test_ambiguous_prefix_gathers_more(self):
+        self.post('/location')
+        res = self.post(
+            '/location/id_digits?prefix=&gathers=1', Digits='0712345'
+        )
+        self.assertIn(b'numDigits="2"', res)
+        self.assertIn(b'Next digits please', res)
+
+        # the ninth digit is in; the full lookup takes over
+        res = self.post('/location/id_digits', Digits='68')
+        self.assertIn(b'Payphone found in Perth', res)
+
+    def test_not_found(self):
+        self.assertEqual(
+            self.post(
+                '/location/id_digits?prefix=&gathers=1', Digits='5555'
+            ).decode(),
+            server.NOT_FOUND_RESPONSE.toxml()
+        )
+
+
+class TestPayPhoneIndex(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.path)
+        self.index = PayPhoneIndex(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def test_wildcard_lookup(self):
+        self.index.build([
+            {'properties': {'CABINET_ID': '08945808-2', 'SSC_Name': 'Wilton'}},
+            {'properties': {'CABINET_ID': '08945808/2', 'SSC_Name': 'Bently'}},
+            {'properties': {'CABINET_ID': '08945809-2', 'SSC_Name': 'Perth'}},
+        ])
+
+        self.assertEqual(
+            [
+                feature['properties']['SSC_Name']
+                for feature in self.index.by_cabinet_id('08945808%2')
+            ],
+            ['Wilton', 'Bently']
+        )
+        self.assertEqual(self.index.by_cabinet_id('18945808%2'), [])
+
+    @patch('payphones.FeatureService.features_by_sql',
+           return_value={'features': PAYPHONE_RESPONSE})
+    def test_falls_back_when_missing(self, features_by_sql):
+        self.assertFalse(self.index.is_fresh())
+        self.assertEqual(
+            PayPhones(self.index).by_cabinet_id('08945808%2'),
+            PAYPHONE_RESPONSE
+        )
+        self.assertTrue(features_by_sql.called)
+
+    @patch('payphones.FeatureService.features_by_sql')
+    def test_falls_back_when_stale(self, features_by_sql):
+        self.index.build(
+            [{'properties': {'CABINET_ID': '08945808-2'}}]
+        )
+        self.index.max_age = 0
+        PayPhones(self.index).by_cabinet_id('08945808%2')
+        self.assertTrue(features_by_sql.called)
+
+
+class TestNearestPayPhones(unittest.TestCase):
+    FEATURES = [
+        {'properties': {'SSC_Name': name, 'Latitude': lat, 'Longitude': lon}}
+        for name, lat, lon in [
+            ('Bentley', -32.001, 115.924),
+            ('Perth', -31.952, 115.861),
+            ('Fremantle', -32.056, 115.745),
+            ('Sydney', -33.868, 151.209),
+        ]
+    ]
+
+    def test_nearest(self):
+        nearest = NearestPayPhones(self.FEATURES)
+        results = nearest.nearest((-32.0, 115.9), max_features=2)
+
+        self.assertEqual(
+            [feature['properties']['SSC_Name'] for feature in results],
+            ['Bentley', 'Perth']
+        )
+        self.assertAlmostEqual(
+            results[0]['properties']['distanceToFeature'], 2.27, places=2
+        )
+        self.assertEqual(
+            nearest.nearest_many([(-32.0, 115.9)], max_features=2),
+            [results]
+        )
+
+    def test_within_distance(self):
+        nearest = NearestPayPhones(self.FEATURES)
+        self.assertEqual(
+            len(nearest.nearest((-32.0, 115.9), within_km=1000)), 3
+        )
+
+
+class TestLexicon(unittest.TestCase):
+    def test_normalize(self):
+        lexicon = Lexicon({
+            'Rd': 'Road', 'Rds': 'Roads', 'Ave': 'Avenue', 'Sq': 'Square',
+            'mins': 'minutes', 'km/h': 'kilometres per hour'
+        })
+
+        self.assertEqual(
+            lexicon.normalize('Ave Sq Rds, 5 mins at 5 km/h (Rd)'),
+            'Avenue Square Roads, 5 minutes at 5 kilometres per hour (Road)'
+        )
+        self.assertEqual(lexicon.normalize('Rdx xRd Avenue'), 'Rdx xRd Avenue')
+
+    def test_load(self):
+        lexicon = Lexicon.load()
+        self.assertGreater(len(lexicon), 100)
+        self.assertEqual(lexicon.normalize('Tce'), 'Terrace')
+
+    def test_saint_names(self):
+        lexicon = Lexicon.load()
+        for text, expected in [
+            ('Turn left onto St Georges Tce',
+             'Turn left onto Saint Georges Terrace'),
+            ('St Kilda Rd', 'Saint Kilda Road'),
+            ('Turn right onto Hay St', 'Turn right onto Hay Street'),
+            ('Continue onto Hay St East', 'Continue onto Hay Street East'),
+            ("O'Connor St West", "O'Connor Street West"),
+            ('Dr Smith Dr', 'Doctor Smith Drive'),
+        ]:
+            with self.subTest(text=text):
+                self.assertEqual(lexicon.normalize(text), expected)
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=10, max_bytes=10)
+        cache.set('a', 1, size=4)
+        cache.set('b', 2, size=4)
+        cache.get('a')
+        cache.set('c', 3, size=4)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertEqual(cache.size, 8)
+
+    def test_clear_resets_stats(self):
+        cache = LRUCache()
+        cache.set('a', 1, size=4)
+        cache.get('a')
+        cache.get('b')
+        cache.clear()
+        self.assertEqual(
+            cache.stats,
+            {'entries': 0, 'size': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        )
+
+    def test_expiry(self):
+        cache = LRUCache()
+        cache.set('a', 1, ttl=0)
+        self.assertNotIn('a', cache)
+
+
+class TestPooledAdapter(unittest.TestCase):
+    def setUp(self):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def test_connections_reused(self):
+        adapter = PooledAdapter(timeout=1)
+        sess = requests.Session()
+        sess.mount('http://', adapter)
+        url = 'http://127.0.0.1:{}/'.format(self.httpd.server_port)
+
+        for _ in range(3):
+            self.assertEqual(sess.get(url).text, 'ok')
+
+        self.assertEqual(
+            adapter.stats,
+            {'requests': 3, 'connections_opened': 1, 'connections_reused': 2}
+        )
+
+
 class TestValidation(unittest.TestCase):
     def test_validation(self):
         res = checksum(
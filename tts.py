@@ -0,0 +1,215 @@
+import os
+import json
+import logging
+import tempfile
+import threading
+from hashlib import sha256
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from auth import AUTH
+from clients import session
+
+SYNTHESIZE_URL = (
+    'https://stream.watsonplatform.net/text-to-speech/api/v1/synthesize'
+)
+VOICE = 'en-US_AllisonVoice'
+MIMETYPE = 'audio/wav'
+EXTENSION = '.wav'
+PRERENDERED_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'static', 'speech'
+)
+watson = session('watson')
+TTS_CACHE_DIR = os.environ.get('TTS_CACHE_DIR', 'tts_cache')
+TTS_CACHE_BYTES = int(os.environ.get('TTS_CACHE_BYTES', 512 * 1024 * 1024))
+
+
+def synthesize(text, voice=VOICE, mimetype=MIMETYPE, stream=True):
+    return watson.get(
+        SYNTHESIZE_URL,
+        params={
+            'text': text,
+            'accept': mimetype,
+            'voice': voice
+        },
+        auth=(AUTH['SPEECH_USERNAME'], AUTH['SPEECH_PASSWORD']),
+        stream=stream
+    )
+
+
+def prerendered_name(text):
+    return AudioCache.key(text, VOICE, MIMETYPE) + EXTENSION
+
+
+def prerendered_names(directory=PRERENDERED_DIR):
+    try:
+        return set(os.listdir(directory))
+    except FileNotFoundError:
+        return set()
+
+
+def presynthesize(texts, directory=PRERENDERED_DIR, concurrency=8):
+    """
+    Render each of `texts` to a static file in `directory`, skipping ones
+    already there. Returns the names of everything rendered; failures are
+    logged and left out.
+    """
+    os.makedirs(directory, exist_ok=True)
+    existing = prerendered_names(directory)
+
+    def render(text):
+        name = prerendered_name(text)
+        if name in existing:
+            return name
+
+        try:
+            res = synthesize(text, stream=False)
+            res.raise_for_status()
+        except Exception:
+            logging.exception('Could not pre-synthesize "%s"', text)
+            return None
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(res.content)
+        os.replace(tmp_path, os.path.join(directory, name))
+        logging.info('Pre-synthesized "%s"', text)
+        return name
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return set(executor.map(render, set(texts))) - {None}
+
+
+class AudioCache:
+    """
+    Content addressed on-disk cache of synthesized speech.
+
+    Files are named for the hash of (text, voice, mimetype), so the name
+    doubles as a strong ETag. Least recently served files are deleted once
+    the directory grows past `max_bytes`. Every worker shares the
+    directory, so its size is read from disk afresh before evicting.
+    """
+
+    def __init__(self, directory=TTS_CACHE_DIR, max_bytes=TTS_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._files = self._scan()
+        self.size = sum(self._files.values())
+
+    def __repr__(self):
+        return '<AudioCache "{}" {} files>'.format(
+            self.directory, len(self._files)
+        )
+
+    def _scan(self):
+        """
+        Sizes of the files in the directory, least recently served first
+        """
+        existing = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                # evicted by another worker
+                continue
+            existing.append((stat.st_atime_ns, name, stat.st_size))
+        return OrderedDict(
+            (name, size) for _, name, size in sorted(existing)
+        )
+
+    @staticmethod
+    def key(text, voice, mimetype):
+        return sha256(
+            json.dumps([text, voice, mimetype]).encode()
+        ).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Path to the cached audio for `key`, or None
+        """
+        with self._lock:
+            if key not in self._files:
+                self.misses += 1
+                return None
+            self._files.move_to_end(key)
+            self.hits += 1
+
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.size -= self._files.pop(key, 0)
+            return None
+        return path
+
+    def write_through(self, key, chunks):
+        """
+        Yield `chunks` unchanged, storing them under `key` once the last
+        one has been seen. Partial streams are thrown away.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete:
+                self._add(key, tmp_path)
+            else:
+                os.unlink(tmp_path)
+
+    def _add(self, key, tmp_path):
+        os.replace(tmp_path, self.path(key))
+        os.utime(self.path(key))
+        # picks up what the other workers have added and evicted too
+        files = self._scan()
+        with self._lock:
+            self._files = files
+            self.size = sum(files.values())
+            evicted = self._evict()
+
+        for name in evicted:
+            try:
+                os.unlink(self.path(name))
+            except FileNotFoundError:
+                pass
+        if evicted:
+            logging.info('Evicted %d cached audio files', len(evicted))
+
+    def _evict(self):
+        evicted = []
+        while len(self._files) > 1 and self.size > self.max_bytes:
+            name, size = self._files.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            evicted.append(name)
+        return evicted
+
+    @property
+    def stats(self):
+        return {
+            'entries': len(self._files),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    from server import warm_prompts
+    warm_prompts()
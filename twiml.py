@@ -1,15 +1,57 @@
-import copy
-
-from lxml.builder import E
-from lxml.etree import tounicode
+import os
+import re
+from hashlib import sha1
+from types import MappingProxyType
 
 from operator import methodcaller
 
 # relatively little overhead, because C <3
 toxml = lambda iterable: list(map(methodcaller('toxml'), iterable))
 
+PREFIX = '<?xml version="1.0" encoding="UTF-8"?>'
+# 'string' writes markup directly, 'lxml' builds and serializes a tree;
+# both produce identical output
+SERIALIZER = os.environ.get('TWIML_SERIALIZER', 'string')
+
+_TEXT_ESCAPES = str.maketrans({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '\r': '&#13;'
+})
+_ATTRIBUTE_ESCAPES = str.maketrans({
+    '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+    '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'
+})
+
+
+def _builder():
+    # only the lxml serializer needs lxml, so only import it for that
+    from lxml.builder import E
+    return E
+
+
+def write_element(out, tag, attributes, text=None, children=()):
+    """
+    Append `tag` to the list `out` as markup, escaped the same way lxml
+    would serialize it
+    """
+    out.append('<' + tag)
+    for key, val in attributes:
+        out.append(' {}="{}"'.format(key, val.translate(_ATTRIBUTE_ESCAPES)))
+
+    if text is None and not children:
+        out.append('/>')
+        return
+
+    out.append('>')
+    if text is not None:
+        out.append(text.translate(_TEXT_ESCAPES))
+    for child in children:
+        child.write(out)
+    out.append('</' + tag + '>')
+
 
 class Container:
+    __slots__ = ('contents',)
+
     def __init__(self, contents=None):
         self.contents = contents or []
 
@@ -20,16 +62,32 @@ class Container:
     def toxml(self):
         return toxml(self.contents)
 
+    def write(self, out):
+        for node in self.contents:
+            node.write(out)
+
 
 class Gather(Container):
-    NODE = E.Gather
+    __slots__ = ('_root', 'numDigits', 'action', 'options')
 
-    def __init__(self, root, numDigits, action, contents=None):
+    def __init__(self, root, numDigits, action, contents=None, **options):
         self._root = root
         self.numDigits = numDigits
         self.action = action
+        # rarer attributes, eg finishOnKey; most gathers have none
+        self.options = {
+            key: val
+            for key, val in options.items()
+            if val is not None
+        } or None
         super().__init__(contents)
 
+    def _attributes(self):
+        attributes = [('action', self.action), ('numDigits', self.numDigits)]
+        if self.options:
+            attributes.extend(sorted(self.options.items()))
+        return attributes
+
     def __enter__(self):
         return self
 
@@ -44,37 +102,58 @@ class Gather(Container):
         ))
 
     def toxml(self):
-        return Gather.NODE(
+        return _builder().Gather(
             *super().toxml(),
-            action=self.action,
-            numDigits=self.numDigits
+            **dict(self._attributes())
+        )
+
+    def write(self, out):
+        write_element(
+            out, 'Gather', self._attributes(), children=self.contents
         )
 
 
 class Say:
-    NODE = E.Say
+    __slots__ = ('_root', 'text', 'kwargs')
 
     def __init__(self, _root, text, **kwargs):
         self._root = _root
         self.text = text
-        self.kwargs = kwargs
+        # most Says only use the response's globals; don't keep an empty dict
+        self.kwargs = {
+            key: val
+            for key, val in kwargs.items()
+            if val is not None
+        } or None
 
     def toxml(self):
-        return Say.NODE(self.text, **self._root.merge_globals(self.kwargs))
+        return _builder().Say(
+            self.text, **self._root.merge_globals(self.kwargs)
+        )
+
+    def write(self, out):
+        write_element(
+            out, 'Say',
+            self._root.merge_globals(self.kwargs).items(),
+            text=self.text
+        )
 
 
 class Pause:
-    NODE = E.Pause
+    __slots__ = ('length',)
 
     def __init__(self, length):
         self.length = length
 
     def toxml(self):
-        return Pause.NODE(length=str(self.length))
+        return _builder().Pause(length=str(self.length))
+
+    def write(self, out):
+        write_element(out, 'Pause', [('length', str(self.length))])
 
 
 class Play:
-    NODE = E.Play
+    __slots__ = ('url', 'digits', 'loop')
 
     def __init__(self, url=None, digits=None, loop=0):
         assert url or digits
@@ -82,49 +161,95 @@ class Play:
         self.digits = digits
         self.loop = loop
 
+    def _attributes(self):
+        return {
+            k: v
+            for k, v in [
+                ('digits', self.digits), ('loop', self.loop)
+            ]
+            if v
+        }
+
     def toxml(self):
-        return Play.NODE(
-            self.url,
-            **{
-                k: v
-                for k, v in [
-                    ('digits', self.digits), ('loop', self.loop)
-                ]
-                if v
-            }
+        return _builder().Play(self.url, **self._attributes())
+
+    def write(self, out):
+        write_element(
+            out, 'Play', self._attributes().items(), text=self.url
         )
 
 
 class WatsonSay(Play):
+    __slots__ = ()
+    # set by the app: the URL `text` is spoken from
+    url_for = None
+
     def __init__(self, _root, text, **kwargs):
-        from server import params_and_url_for
-        super().__init__(
-            url=params_and_url_for('speech', {'text': text})
+        super().__init__(url=WatsonSay.url_for(text))
+
+
+class Redirect:
+    __slots__ = ('url', 'method')
+
+    def __init__(self, url, method='POST'):
+        self.url = url
+        self.method = method
+
+    def toxml(self):
+        return _builder().Redirect(self.url, method=self.method)
+
+    def write(self, out):
+        write_element(
+            out, 'Redirect', [('method', self.method)], text=self.url
         )
 
 
 class Hangup:
-    NODE = E.Hangup
+    __slots__ = ()
 
     def toxml(self):
-        return Hangup.NODE()
+        return _builder().Hangup()
+
+    def write(self, out):
+        out.append('<Hangup/>')
 
 
 class Response(Container):
-    NODE = E.Response
-
-    def __init__(self):
-        self._classes = {
-            'gather': Gather,
-            # 'say': WatsonSay,
-            'say': Say,
-            'pause': Pause,
-            'hangup': Hangup,
-            'play': Play
-        }
-        self.globals = {'language': 'en-AU'}
+    __slots__ = ('serializer', 'globals', '_classes')
+
+    # shared by every response until one overrides them, see set_global
+    # and register
+    CLASSES = MappingProxyType({
+        'gather': Gather,
+        # 'say': WatsonSay,
+        'say': Say,
+        'pause': Pause,
+        'hangup': Hangup,
+        'play': Play,
+        'redirect': Redirect
+    })
+    GLOBALS = MappingProxyType({'language': 'en-AU'})
+
+    def __init__(self, serializer=None):
+        self.serializer = serializer or SERIALIZER
+        self._classes = Response.CLASSES
+        self.globals = Response.GLOBALS
         super().__init__()
 
+    def register(self, verb, cls):
+        """
+        Use `cls` for `verb` in this response only
+        """
+        self._classes = MappingProxyType(dict(self._classes, **{verb: cls}))
+        return self
+
+    def set_global(self, key, val):
+        """
+        Set an attribute on every Say in this response only
+        """
+        self.globals = MappingProxyType(dict(self.globals, **{key: val}))
+        return self
+
     def say(self, text, language=None):
         return self.add(self._classes['say'](
             self,
@@ -144,25 +269,107 @@ class Response(Container):
     def hangup(self):
         return self.add(self._classes['hangup']())
 
+    def redirect(self, url, method='POST'):
+        return self.add(self._classes['redirect'](url, method=method))
+
     def toxml(self):
-        root = Response.NODE(*super().toxml())
+        if self.serializer == 'string':
+            out = [PREFIX]
+            write_element(out, 'Response', (), children=self.contents)
+            return ''.join(out)
 
-        prefix = '<?xml version="1.0" encoding="UTF-8"?>'
-        return prefix + tounicode(root)
+        from lxml.etree import tounicode
+        root = _builder().Response(*super().toxml())
+        return PREFIX + tounicode(root)
 
-    def gather(self, numDigits=None, action=None):
+    def gather(self, numDigits=None, action=None, finishOnKey=None,
+               actionOnEmptyResult=None, timeout=None):
         res = self._classes['gather'](
             self,
             numDigits=str(numDigits) if numDigits else None,
-            action=action
+            action=action,
+            finishOnKey=finishOnKey,
+            actionOnEmptyResult=actionOnEmptyResult,
+            timeout=str(timeout) if timeout else None
         )
         self.add(res)
         return res
 
     def merge_globals(self, specific):
-        specific = {
-            key: val
-            for key, val in specific.items()
-            if val is not None
-        }
-        return dict(copy.deepcopy(self.globals), **specific)
+        if not specific:
+            return self.globals
+        return dict(self.globals, **specific)
+
+
+class Constant:
+    """
+    A response that never changes, built and rendered on first use.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self._xml = self._etag = None
+
+    def toxml(self):
+        if self._xml is None:
+            self._xml = self.build().toxml()
+        return self._xml
+
+    @property
+    def etag(self):
+        if self._etag is None:
+            self._etag = sha1(self.toxml().encode()).hexdigest()
+        return self._etag
+
+
+class Rendered:
+    __slots__ = ('xml',)
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def toxml(self):
+        return self.xml
+
+
+class Template:
+    """
+    A response with a few varying fields, rendered once with placeholders.
+
+    `build` is called with a placeholder for each field; fields used in
+    text go in `text`, ones used as attribute values in `attributes`, so
+    each is escaped correctly when substituted.
+    """
+    # private use characters, which no escaping touches
+    MARKER = '\ue000{}\ue001'
+    MARKER_RE = re.compile('\ue000(\\w+)\ue001')
+
+    def __init__(self, build, text=(), attributes=()):
+        self.build = build
+        self.escapes = dict(
+            [(name, _TEXT_ESCAPES) for name in text] +
+            [(name, _ATTRIBUTE_ESCAPES) for name in attributes]
+        )
+        self._parts = None
+
+    def _compile(self):
+        xml = self.build(**{
+            name: Template.MARKER.format(name)
+            for name in self.escapes
+        }).toxml()
+        parts = Template.MARKER_RE.split(xml)
+        if set(parts[1::2]) != set(self.escapes):
+            raise ValueError(
+                'Not every field survived rendering: {}'.format(parts[1::2])
+            )
+        return parts
+
+    def render(self, **fields):
+        if self._parts is None:
+            self._parts = self._compile()
+
+        parts = list(self._parts)
+        for idx in range(1, len(parts), 2):
+            name = parts[idx]
+            parts[idx] = str(fields[name]).translate(self.escapes[name])
+        return Rendered(''.join(parts))